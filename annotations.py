@@ -0,0 +1,139 @@
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from state_store import OUTPUT_DIR, STATE_PATH, CSV_PATH, PARQUET_AVAILABLE
+
+logger = logging.getLogger(__name__)
+
+ANNOTATIONS_PATH = os.path.join(OUTPUT_DIR, 'annotations.sqlite')
+# User fields and their value for games without an annotation. A new field only
+# needs an entry here, the column is added to an existing store on connect.
+FIELDS = {
+    'played': False,
+    'wishlist': False
+}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def connect(path=ANNOTATIONS_PATH):
+    '''
+    Open the annotation store, creating the table and adding missing field
+    columns if needed. A new store is filled with the played and wishlist flags
+    that older versions kept in the state file.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS annotations (
+            name TEXT PRIMARY KEY,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    existing = {row[1] for row in connection.execute('PRAGMA table_info(annotations)')}
+    created = not existing & set(FIELDS)
+    with connection:
+        for field, default in FIELDS.items():
+            if field not in existing:
+                connection.execute(f'ALTER TABLE annotations ADD COLUMN {field} INTEGER NOT NULL DEFAULT {int(default)}')
+    if created and path == ANNOTATIONS_PATH:
+        migrate_state_flags(connection)
+    return connection
+
+
+def ensure_store(path=ANNOTATIONS_PATH):
+    '''
+    Create the annotation store if it doesn't exist yet. Called before the state
+    is saved, so the flags of an older state file are moved before they are dropped.
+    '''
+    connect(path).close()
+
+
+def legacy_flags():
+    '''
+    Return the name and user fields stored in the state file by older versions,
+    or None if the state file doesn't have them.
+    '''
+    columns = ['name', *FIELDS]
+    if PARQUET_AVAILABLE and os.path.exists(STATE_PATH):
+        import pyarrow.parquet as pq
+        if not set(columns) <= set(pq.read_schema(STATE_PATH).names):
+            return None
+        return pd.read_parquet(STATE_PATH, columns=columns)
+    if os.path.exists(CSV_PATH):
+        header = pd.read_csv(CSV_PATH, nrows=0).columns
+        if not set(columns) <= set(header):
+            return None
+        df = pd.read_csv(CSV_PATH, usecols=columns)
+        for field in FIELDS:
+            df[field] = df[field].map({True: True, 'True': True}).fillna(False)
+        return df
+    return None
+
+
+def migrate_state_flags(connection):
+    df = legacy_flags()
+    if df is None:
+        return
+    # Only games with a field set differ from the defaults
+    changed = pd.Series(False, index=df.index)
+    for field, default in FIELDS.items():
+        changed |= df[field].fillna(default).astype(bool) != default
+    count = upsert(df.loc[changed], connection=connection)
+    logger.info(f"Moved {count} annotations from the state file to the annotation store")
+
+
+def load_annotations(path=ANNOTATIONS_PATH):
+    '''
+    Return all annotations as a DataFrame with the name and the user fields.
+    '''
+    connection = connect(path)
+    try:
+        df = pd.read_sql_query(f'SELECT name, {", ".join(FIELDS)} FROM annotations', connection)
+    finally:
+        connection.close()
+    return df.astype({'name': 'string', **{field: 'boolean' for field in FIELDS}})
+
+
+def join_annotations(df, path=ANNOTATIONS_PATH):
+    '''
+    Add the user fields to a DataFrame of games, by name. Games without an
+    annotation get the default values.
+    '''
+    annotations = load_annotations(path)
+    df = df.drop(columns=[field for field in FIELDS if field in df.columns])
+    df = df.merge(annotations, how='left', on='name')
+    for field, default in FIELDS.items():
+        df[field] = df[field].fillna(default).astype('boolean')
+    return df
+
+
+def upsert(df, connection=None, path=ANNOTATIONS_PATH):
+    '''
+    Insert or update the annotations of the games in df, by name. Only the rows
+    in df are written, and fields missing from df keep their stored value.
+    Returns the number of rows written.
+    '''
+    fields = [field for field in FIELDS if field in df.columns]
+    if df.empty or not fields:
+        return 0
+    updated_at = datetime.now().strftime(TIME_FORMAT)
+    rows = [(name, updated_at, *(bool(value) for value in values))
+            for name, *values in zip(df['name'], *(df[field].fillna(FIELDS[field]) for field in fields))]
+
+    own_connection = connection is None
+    connection = connection or connect(path)
+    try:
+        with connection:
+            connection.executemany(
+                f'''INSERT INTO annotations (name, updated_at, {", ".join(fields)})
+                    VALUES (?, ?, {", ".join('?' for _ in fields)})
+                    ON CONFLICT (name) DO UPDATE SET updated_at = excluded.updated_at,
+                    {", ".join(f"{field} = excluded.{field}" for field in fields)}''', rows)
+    finally:
+        if own_connection:
+            connection.close()
+    return len(rows)
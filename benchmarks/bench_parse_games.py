@@ -0,0 +1,96 @@
+'''
+Micro-benchmark of the parse_games engines on saved listing pages.
+
+Every engine is run on the HTML files in benchmarks/fixtures/ and must return
+exactly the same games as the 'html.parser' engine.
+
+Usage:
+    python benchmarks/bench_parse_games.py [--repeat N]
+    python benchmarks/bench_parse_games.py --capture 3   # save pages 1-3 as fixtures
+'''
+import argparse
+import glob
+import os
+import sys
+import time
+
+# Make the project modules importable when running the script directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dragon_scrape import PARSER_ENGINES, fetch_page, parse_games
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE_ENGINE = 'html.parser'
+
+
+def load_fixtures(fixture_dir=FIXTURE_DIR):
+    '''
+    Load the saved listing pages, keyed by file name.
+    '''
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(fixture_dir, 'listing_page_*.html'))):
+        with open(path, encoding='utf-8') as file:
+            fixtures[os.path.basename(path)] = file.read()
+    return fixtures
+
+
+def capture_fixtures(page_count, fixture_dir=FIXTURE_DIR):
+    '''
+    Save the first pages of the live listing as fixtures.
+    '''
+    os.makedirs(fixture_dir, exist_ok=True)
+    for page_number in range(1, page_count + 1):
+        page_content = fetch_page(page_number)
+        if not page_content:
+            break
+        with open(os.path.join(fixture_dir, f'listing_page_{page_number}.html'), 'w', encoding='utf-8') as file:
+            file.write(page_content)
+        print(f'Saved page {page_number}')
+
+
+def time_engine(engine, pages, repeat):
+    '''
+    Return the best time of parsing all pages once with an engine.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page_content in pages:
+            parse_games(page_content, engine)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help='number of timed runs per engine')
+    parser.add_argument('--capture', type=int, metavar='PAGES', help='save the first PAGES live pages as fixtures and exit')
+    args = parser.parse_args()
+
+    if args.capture:
+        capture_fixtures(args.capture)
+        return
+
+    fixtures = load_fixtures()
+    if not fixtures:
+        sys.exit(f'No fixtures found in {FIXTURE_DIR}')
+
+    # All engines must return the same games as the full BeautifulSoup tree
+    pages = list(fixtures.values())
+    for file_name, page_content in fixtures.items():
+        expected = parse_games(page_content, BASELINE_ENGINE)
+        for engine in PARSER_ENGINES:
+            if parse_games(page_content, engine) != expected:
+                sys.exit(f'Engine {engine} returned different games for {file_name}')
+
+    game_count = sum(len(parse_games(page_content, BASELINE_ENGINE)) for page_content in pages)
+    print(f'{len(pages)} pages, {game_count} games, best of {args.repeat} runs')
+
+    baseline = time_engine(BASELINE_ENGINE, pages, args.repeat)
+    for engine in PARSER_ENGINES:
+        seconds = baseline if engine == BASELINE_ENGINE else time_engine(engine, pages, args.repeat)
+        print(f'{engine:>12}: {seconds * 1000:8.2f} ms  {baseline / seconds:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
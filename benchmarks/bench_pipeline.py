@@ -0,0 +1,211 @@
+'''
+End-to-end benchmark of the scrape and enrichment pipeline, run against the
+local replay server (benchmarks/replay_server.py) so no request leaves the machine.
+
+For every catalogue size the stages are timed in a fresh process working on a
+temporary copy of the project, so the benchmark never touches output/:
+
+    scrape_all_pages  fetch and parse all listing pages
+    parse_games       parse the fetched pages again, without the requests
+    clean_data        turn the games into a DataFrame
+    pipeline_cold     main.run_update on an empty output directory
+    generate_output   compare a new scrape with the saved state
+    pipeline_warm     main.run_update again, with the caches and state of the first run
+    pipeline_unchanged  main.run_update when nothing changed since the last update
+
+The JSON results also hold the run report (metrics.py) of the pipeline runs.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--sizes 1000,10000,100000] [--json results.json]
+    python benchmarks/bench_pipeline.py --sizes 1000 --latency 0.005 --rate-limit-every 50 --malformed-share 0.01
+'''
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+SIZES = (1000, 10000, 100000)
+STAGES = ('scrape_all_pages', 'parse_games', 'clean_data', 'pipeline_cold', 'generate_output', 'pipeline_warm',
+          'pipeline_unchanged')
+# Large catalogues are served with bigger pages, so they stay below MAX_PAGES
+MAX_BENCH_PAGES = 400
+
+
+def page_size_for(size):
+    from replay_server import PAGE_SIZE
+    return max(PAGE_SIZE, -(-size // MAX_BENCH_PAGES))
+
+
+def prepare_workdir():
+    '''
+    Copy the project modules to a temporary directory. The pipeline writes its
+    output next to the modules, so the copy keeps output/ of the project untouched.
+    '''
+    workdir = tempfile.mkdtemp(prefix='dragon-scrape-bench-')
+    for path in glob.glob(os.path.join(REPO_DIR, '*.py')):
+        shutil.copy(path, workdir)
+    return workdir
+
+
+def check_workdir(module, workdir):
+    '''
+    Make sure a module was imported from the working copy and not from the project.
+    '''
+    if os.path.dirname(os.path.abspath(module.__file__)) != os.path.abspath(workdir):
+        raise RuntimeError(f'{module.__name__} was imported from {module.__file__}, not from {workdir}')
+
+
+def run_stages(size, args):
+    '''
+    Time the stages for one catalogue size. Runs in the worker process, with the
+    working copy of the project first on the path.
+    '''
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.path.insert(0, args.workdir)
+    import state_store
+    import transport
+    from replay_server import Catalogue, ReplayServer
+    # replay_server puts the project on the path, the working copy has to stay first
+    sys.path.insert(0, args.workdir)
+    check_workdir(state_store, args.workdir)
+    import bgg_api
+    from dragon_scrape import scrape_all_pages, fetch_page, find_page_count, parse_games, clean_data, generate_output
+    from rate_governor import RateGovernor
+
+    catalogue = Catalogue(size, seed=args.seed)
+    server = ReplayServer(catalogue, page_size=page_size_for(size), latency=args.latency,
+                          rate_limit_every=args.rate_limit_every, malformed_share=args.malformed_share).start()
+    transport.set_transport(transport.Transport(host_overrides=server.host_overrides(), backoff=0.01))
+    # The local server has no rate limit, only the concurrency of the client is kept
+    bgg_api.governor = RateGovernor(rate=1e6, burst=1e6, concurrency=bgg_api.ID_WORKERS,
+                                    max_concurrency=bgg_api.ID_WORKERS, name=bgg_api.governor.name)
+
+    timings = {}
+    requests = {}
+    reports = {}
+
+    def timed(stage, function):
+        before = dict(server.counters)
+        start = time.perf_counter()
+        result = function()
+        timings[stage] = time.perf_counter() - start
+        requests[stage] = {path: count - before.get(path, 0) for path, count in server.counters.items()
+                           if count - before.get(path, 0)}
+        return result
+
+    games = timed('scrape_all_pages', lambda: scrape_all_pages(use_cache=False))
+    first_page = fetch_page(1)
+    pages = [first_page] + [fetch_page(n) for n in range(2, (find_page_count(first_page) or 1) + 1)]
+    timed('parse_games', lambda: [parse_games(page_content) for page_content in pages])
+    timed('clean_data', lambda: clean_data(games))
+
+    # Importing main sets up logging and moves into the working copy
+    import main
+    import metrics
+    check_workdir(main, args.workdir)
+
+    def run_pipeline(stage):
+        # Keep the run report of the pipeline, with its stage and HTTP metrics
+        metrics.reset()
+        timed(stage, main.run_update)
+        reports[stage] = metrics.report('finished')
+
+    run_pipeline('pipeline_cold')
+
+    catalogue.advance()
+    new_run = clean_data(scrape_all_pages(use_cache=False))
+    timed('generate_output', lambda: generate_output(new_run))
+    run_pipeline('pipeline_warm')
+    # The statuses of the warm run settle in one more update, after that nothing changes
+    main.run_update()
+    run_pipeline('pipeline_unchanged')
+
+    server.stop()
+    return {'games': size, 'scraped': len(games), 'page_size': server.page_size,
+            'timings': timings, 'requests': requests, 'run_reports': reports}
+
+
+def run_size(size, args):
+    '''
+    Run the stages for one size in a fresh process and return its results.
+    '''
+    workdir = prepare_workdir()
+    result_path = os.path.join(workdir, 'bench_result.json')
+    command = [sys.executable, os.path.abspath(__file__), '--worker', str(size), '--workdir', workdir,
+               '--result', result_path, '--seed', str(args.seed), '--latency', str(args.latency),
+               '--rate-limit-every', str(args.rate_limit_every), '--malformed-share', str(args.malformed_share)]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(result_path, encoding='utf-8') as file:
+            return json.load(file)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f'Kept the working copy in {workdir}')
+
+
+def print_results(results):
+    '''
+    Print the seconds and games per second of every stage and size.
+    '''
+    print(f"{'games':>20}" + ''.join(f"{result['games']:>24,}" for result in results))
+    for stage in STAGES:
+        row = f'{stage:>20}'
+        for result in results:
+            seconds = result['timings'][stage]
+            row += f'{seconds:>10.3f} s {result["games"] / max(seconds, 1e-9):>9,.0f}/s'
+        print(row)
+    print()
+    for result in results:
+        print(f"{result['games']:,} games ({result['page_size']} per page), requests per stage:")
+        for stage in STAGES:
+            if result['requests'].get(stage):
+                counts = ', '.join(f'{path} {count:,}' for path, count in sorted(result['requests'][stage].items()))
+                print(f'{stage:>20}: {counts}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='comma separated catalogue sizes')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic catalogue')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server adds to every request')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='answer every Nth BGG request with a 429')
+    parser.add_argument('--malformed-share', type=float, default=0.0, help='share of malformed BGG items')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the working copies')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_stages(args.worker, args)
+        with open(args.result, 'w', encoding='utf-8') as file:
+            json.dump(result, file)
+        return
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        print(f'Running {size:,} games...', flush=True)
+        results.append(run_size(size, args))
+    print()
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
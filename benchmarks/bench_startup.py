@@ -0,0 +1,90 @@
+'''
+Startup benchmark of the command line. Every measurement runs in a fresh
+interpreter on a temporary copy of the project, and the median of the runs is
+compared with its budget:
+
+    help        python main.py --help
+    fast_path   importing what an update needs to scrape and find that nothing
+                changed (main, dragon_scrape and the state digest)
+
+The fast path must not import pandas, BeautifulSoup or numpy at all. The exit
+code is 1 if a budget is exceeded or one of them is imported.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 10] [--json results.json]
+'''
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+from bench_pipeline import prepare_workdir  # noqa: E402
+
+# Seconds of wall time, including the start of the interpreter
+BUDGETS = {
+    'help': 0.2,
+    'fast_path': 0.4
+}
+HEAVY_MODULES = ('pandas', 'bs4', 'numpy')
+FAST_PATH_IMPORTS = 'import main, dragon_scrape, state_digest'
+
+
+def time_command(command, workdir):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def heavy_imports(workdir):
+    '''
+    Return the heavy modules imported by the fast path.
+    '''
+    check = f'import sys; {FAST_PATH_IMPORTS}; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', check], cwd=workdir, check=True,
+                            capture_output=True, text=True).stdout.strip()
+    return output.split(',') if output else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='runs per measurement')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    try:
+        commands = {
+            'help': [sys.executable, os.path.join(workdir, 'main.py'), '--help'],
+            'fast_path': [sys.executable, '-c', FAST_PATH_IMPORTS]
+        }
+        # The first run fills the bytecode cache of the copy
+        for command in commands.values():
+            time_command(command, workdir)
+        timings = {name: statistics.median(time_command(command, workdir) for _ in range(args.runs))
+                   for name, command in commands.items()}
+        imported = heavy_imports(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    over_budget = False
+    for name, seconds in timings.items():
+        within = seconds <= BUDGETS[name]
+        over_budget |= not within
+        print(f"{name:>10}: {seconds:.3f} s (budget {BUDGETS[name]:.3f} s){'' if within else ' OVER BUDGET'}")
+    if imported:
+        print(f"The fast path imports {', '.join(imported)}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'timings': timings, 'budgets': BUDGETS, 'heavy_imports': imported}, file, indent=2)
+    return 1 if over_budget or imported else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,409 @@
+'''
+Local stand-in for the Dragonslair listing and the BGG XML API.
+
+The server answers the listing pages, the search endpoint and the thing endpoint
+from a synthetic catalogue, or with responses recorded from the live sites.
+Latency, 429 responses and malformed BGG items can be injected. Point the
+scraper and the BGG client at it through the host overrides of the transport:
+
+    server = ReplayServer(Catalogue(1000)).start()
+    set_transport(Transport(host_overrides=server.host_overrides()))
+
+Usage:
+    python benchmarks/replay_server.py serve --games 1000 [--port 8000] [--recordings DIR]
+    python benchmarks/replay_server.py record DIR [--games 50]   # record the live sites
+'''
+import argparse
+import hashlib
+import html
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit, urlencode
+
+# Make the project modules importable when running the script directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import Transport
+
+LISTING_PATH = '/lanebiblioteket/'
+SEARCH_PATH = '/xmlapi2/search'
+THING_PATH = '/xmlapi2/thing'
+HOSTS = ('dragonslair.se', 'boardgamegeek.com')
+PAGE_SIZE = 48
+
+WORDS = ['Dragon', 'Castle', 'Harbor', 'Forest', 'Empire', 'Garden', 'Island', 'Railway', 'Tavern', 'Dungeon',
+         'Kingdom', 'River', 'Mountain', 'Galaxy', 'Station', 'Market', 'Temple', 'Village', 'Ocean', 'Desert',
+         'Lords', 'Legends', 'Heroes', 'Rivals', 'Secrets', 'Shadows', 'Masters', 'Builders', 'Traders', 'Explorers',
+         'Golden', 'Hidden', 'Lost', 'Ancient', 'Crimson', 'Silent', 'Wild', 'Iron', 'Frozen', 'Burning']
+EDITIONS = [' (Svensk utgåva)', ' (Nordisk utgåva)', ' (Engelsk)']
+SALE_PREFIX = '-Säljs från Lånebiblioteket- '
+
+
+class Catalogue:
+    '''
+    Synthetic library of `size` games, the same for the same seed. A tenth of
+    the names have an edition suffix and a few are marked as for sale, like on
+    the live site. advance() flips the availability of `churn` of the games.
+    '''
+
+    def __init__(self, size, seed=0, churn=0.02):
+        self.random = random.Random(seed)
+        self.churn = churn
+        self.games = []
+        self.by_title = {}
+        seen = set()
+        for i in range(size):
+            title = ' '.join(self.random.sample(WORDS, self.random.randint(2, 3)))
+            if title in seen:
+                title = f'{title} {i}'
+            seen.add(title)
+            name = title
+            roll = self.random.random()
+            if roll < 0.1:
+                name += self.random.choice(EDITIONS)
+            elif roll < 0.13:
+                name = SALE_PREFIX + name
+            game = {'product_id': 100000 + i, 'bgg_id': i + 1, 'title': title, 'name': name,
+                    'available': self.random.random() < 0.6}
+            self.games.append(game)
+            self.by_title[title] = game
+
+    def advance(self):
+        '''
+        Change the availability of some games, as between two runs.
+        '''
+        for game in self.random.sample(self.games, int(len(self.games) * self.churn)):
+            game['available'] = not game['available']
+
+    def page_count(self, page_size):
+        return max(1, -(-len(self.games) // page_size))
+
+    def listing_page(self, page_number, page_size):
+        '''
+        Return a listing page with the markup of the live site. Pages past the end
+        have no game cards.
+        '''
+        games = self.games[(page_number - 1) * page_size:page_number * page_size] if page_number >= 1 else []
+        cards = ''.join(listing_card(game, position) for position, game in enumerate(games, 1))
+        page_count = self.page_count(page_size)
+        links = sorted({1, *range(max(1, page_number - 2), min(page_count, page_number + 2) + 1), page_count})
+        pagination = ''.join(f'<li><a class="pagination-link" href="?page={number}">{number}</a></li>'
+                             for number in links)
+        return LISTING_TEMPLATE.format(cards=cards, pagination=pagination)
+
+    def search_response(self, query):
+        '''
+        Return the search response for a query: the game with that title, if
+        any, and two expansions of it.
+        '''
+        game = self.by_title.get(query)
+        if game is None:
+            return '<items total="0" termsofuse="https://boardgamegeek.com/xmlapi/termsofuse"></items>'
+        items = [(game['bgg_id'], game['title'])]
+        items += [(game['bgg_id'] + 1000000 * n, f"{game['title']}: {suffix}")
+                  for n, suffix in ((1, 'Expansion'), (2, 'Big Box'))]
+        return (f'<items total="{len(items)}" termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">'
+                + ''.join(f'<item type="boardgame" id="{bgg_id}"><name type="primary" value="{html.escape(title)}"/>'
+                          f'<yearpublished value="2015"/></item>' for bgg_id, title in items)
+                + '</items>')
+
+    def thing_response(self, bgg_ids, malformed_share=0.0):
+        '''
+        Return the thing response for a list of IDs. A share of the items can be
+        malformed, with the poll summary missing. The same items are malformed
+        on every request, like a broken entry on the live site.
+        '''
+        items = []
+        for bgg_id in bgg_ids:
+            if not bgg_id.isdigit() or not 1 <= int(bgg_id) <= len(self.games):
+                continue
+            game = self.games[int(bgg_id) - 1]
+            malformed = (int(bgg_id) * 2654435761) % 1000 < malformed_share * 1000
+            items.append(thing_item(game, malformed))
+        return '<items termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">' + ''.join(items) + '</items>'
+
+
+def listing_card(game, position):
+    product = {'id': game['product_id'], 'name': f"-Lånebiblioteket- {game['name']}", 'price': '0.00',
+               'brand': 'Lånebiblioteket', 'category': 'Lånebiblioteket', 'variant': '',
+               'list': 'Lånebiblioteket', 'position': position}
+    stock = ('<div class="stock in-stock"><span class="icon"><i class="fa fa-check"></i></span>\n Finns i lager\n</div>'
+             if game['available'] else
+             '<div class="stock out-of-stock"><span class="icon"><i class="fa fa-times"></i></span>\n Slut i lager\n</div>')
+    return CARD_TEMPLATE.format(product=html.escape(json.dumps(product, ensure_ascii=False)),
+                                product_id=game['product_id'], name=html.escape(product['name']), stock=stock)
+
+
+def thing_item(game, malformed=False):
+    bgg_id = game['bgg_id']
+    poll = ('' if malformed else
+            '<poll-summary name="suggested_numplayers" title="User Suggested Number of Players">'
+            f'<result name="bestwith" value="Best with {2 + bgg_id % 3} players"/>'
+            f'<result name="recommmendedwith" value="Recommended with 1–{3 + bgg_id % 3} players"/></poll-summary>')
+    rank = 'Not Ranked' if bgg_id % 7 == 0 else bgg_id
+    return (f'<item type="boardgame" id="{bgg_id}"><name type="primary" sortindex="1" value="{html.escape(game["title"])}"/>'
+            f'<yearpublished value="{1990 + bgg_id % 35}"/>{poll}<statistics page="1"><ratings>'
+            f'<usersrated value="{bgg_id % 5000}"/><average value="{5 + bgg_id % 40 / 10:.2f}"/>'
+            f'<ranks><rank type="subtype" id="1" name="boardgame" value="{rank}"/></ranks></ratings></statistics></item>')
+
+
+CARD_TEMPLATE = '''
+      <div class="column is-half-mobile is-one-third-tablet is-one-quarter-desktop" data-product-object="{product}">
+        <div class="product-card">
+          <a class="product-card__image" href="/produkt/{product_id}/">
+            <figure class="image is-square"><img loading="lazy" src="/media/products/{product_id}/thumb.webp" alt=""></figure>
+          </a>
+          <div class="product-card__content">
+            <p class="product-card__brand">Lånebiblioteket</p>
+            <h3 class="product-card__title"><a href="/produkt/{product_id}/">{name}</a></h3>
+            <div class="product-card__footer level is-mobile">
+              <div class="level-left"><span class="price">0 kr</span></div>
+              <div class="level-right">{stock}</div>
+            </div>
+          </div>
+        </div>
+      </div>'''
+
+LISTING_TEMPLATE = '''<!DOCTYPE html>
+<html lang="sv">
+<head>
+  <meta charset="utf-8">
+  <title>Lånebiblioteket - Dragonslair</title>
+  <link rel="stylesheet" href="/static/css/main.css">
+</head>
+<body>
+  <main class="section">
+    <div class="container">
+      <h1 class="title">Lånebiblioteket</h1>
+      <div class="columns is-multiline is-mobile product-list">{cards}
+      </div>
+      <nav class="pagination" role="navigation">
+        <ul class="pagination-list">{pagination}</ul>
+      </nav>
+    </div>
+  </main>
+</body>
+</html>
+'''
+
+
+class Recordings:
+    '''
+    Directory of recorded responses, keyed by the path and query of the request.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, path, query):
+        key = path + '?' + urlencode(sorted(query.items()))
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def lookup(self, path, query):
+        '''
+        Return the recorded (status, headers, body) of a request, or None.
+        '''
+        base = self.path(path, query)
+        try:
+            with open(base + '.json', encoding='utf-8') as file:
+                meta = json.load(file)
+            with open(base + '.body', 'rb') as file:
+                return meta['status'], meta['headers'], file.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, path, query, status, headers, body):
+        os.makedirs(self.directory, exist_ok=True)
+        base = self.path(path, query)
+        with open(base + '.body', 'wb') as file:
+            file.write(body)
+        with open(base + '.json', 'w', encoding='utf-8') as file:
+            json.dump({'path': path, 'query': query, 'status': status, 'headers': headers}, file)
+
+
+class RecordingTransport(Transport):
+    '''
+    Transport that saves every response it receives to a Recordings directory.
+    '''
+
+    def __init__(self, recordings, **kwargs):
+        super().__init__(**kwargs)
+        self.recordings = recordings
+
+    def get(self, url, params=None, headers=None):
+        response = super().get(url, params=params, headers=headers)
+        query = {key: str(value) for key, value in (params or {}).items()}
+        kept_headers = {key: value for key, value in response.headers.items()
+                        if key.lower() in ('content-type', 'etag', 'last-modified', 'retry-after')}
+        self.recordings.save(urlsplit(url).path, query, response.status_code, kept_headers, response.content)
+        return response
+
+
+class ReplayServer:
+    '''
+    Threaded HTTP server answering the listing, search and thing requests.
+
+    Recorded responses are served when there is one for the request, otherwise
+    the answer comes from the catalogue. latency is added to every request,
+    every rate_limit_every-th BGG request is answered with a 429, and
+    malformed_share of the BGG items are malformed. Requests are counted per path.
+    '''
+
+    def __init__(self, catalogue, port=0, page_size=PAGE_SIZE, latency=0.0, rate_limit_every=0,
+                 retry_after=0, malformed_share=0.0, recordings=None):
+        self.catalogue = catalogue
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.malformed_share = malformed_share
+        self.recordings = recordings
+        self.counters = {}
+        self.bgg_requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def host_overrides(self):
+        return {host: self.url for host in HOSTS}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, path):
+        with self.lock:
+            self.counters[path] = self.counters.get(path, 0) + 1
+            if path != LISTING_PATH:
+                self.bgg_requests += 1
+                return self.bgg_requests
+
+    def respond(self, path, query):
+        '''
+        Return the (status, headers, body) for a request.
+        '''
+        number = self.count(path)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.recordings is not None:
+            recorded = self.recordings.lookup(path, query)
+            if recorded is not None:
+                return recorded
+
+        if path == LISTING_PATH:
+            page_number = int(query.get('page', 1))
+            body = self.catalogue.listing_page(page_number, self.page_size)
+            return 200, {'Content-Type': 'text/html; charset=utf-8'}, body.encode('utf-8')
+        if path in (SEARCH_PATH, THING_PATH):
+            if self.rate_limit_every and number % self.rate_limit_every == 0:
+                return 429, {'Retry-After': str(self.retry_after)}, b'Rate limit exceeded'
+            if path == SEARCH_PATH:
+                body = self.catalogue.search_response(query.get('query', ''))
+            else:
+                body = self.catalogue.thing_response(query.get('id', '').split(','), self.malformed_share)
+            return 200, {'Content-Type': 'text/xml; charset=utf-8'}, body.encode('utf-8')
+        return 404, {}, b'Not found'
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                query = dict(parse_qsl(parts.query))
+                status, headers, body = server.respond(parts.path, query)
+
+                # Answer conditional requests like the live site
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    status, body = 304, b''
+                self.send_response(status)
+                for key, value in headers.items():
+                    if key.lower() != 'etag':
+                        self.send_header(key, value)
+                if status in (200, 304):
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def record(directory, game_count):
+    '''
+    Record the live listing pages and the BGG responses for the first games.
+    '''
+    import bgg_api
+    import transport
+    from dragon_scrape import scrape_all_pages, clean_data
+
+    transport.set_transport(RecordingTransport(Recordings(directory)))
+    games = clean_data(scrape_all_pages(use_cache=False))
+    print(f'Recorded the listing with {len(games)} games')
+    ids = bgg_api.call_bgg_for_id(games['name'].head(game_count).tolist())
+    bgg_api.call_bgg_for_details(bgg_api.pd.DataFrame(ids, columns=['name', 'id', 'match_confidence']))
+    print(f'Recorded the BGG responses for {len(ids)} games in {directory}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve', help='serve the catalogue and recorded responses')
+    serve.add_argument('--games', type=int, default=1000, help='size of the synthetic catalogue')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    serve.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    serve.add_argument('--rate-limit-every', type=int, default=0, help='answer every Nth BGG request with a 429')
+    serve.add_argument('--malformed-share', type=float, default=0.0, help='share of malformed BGG items')
+    serve.add_argument('--recordings', help='directory of recorded responses to serve')
+    record_parser = subparsers.add_parser('record', help='record responses of the live sites')
+    record_parser.add_argument('directory')
+    record_parser.add_argument('--games', type=int, default=50, help='number of games to record BGG responses for')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.directory, args.games)
+        return
+
+    server = ReplayServer(Catalogue(args.games), port=args.port, page_size=args.page_size, latency=args.latency,
+                          rate_limit_every=args.rate_limit_every, malformed_share=args.malformed_share,
+                          recordings=Recordings(args.recordings) if args.recordings else None)
+    print(f'Serving {args.games} games on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
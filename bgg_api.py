@@ -3,120 +3,344 @@ import xml.etree.ElementTree as etree
 import pandas as pd
 import logging
 import re
-import time
+from concurrent.futures import ThreadPoolExecutor
+from rate_governor import RateGovernor
+from name_index import NameIndex, RESOLVE_THRESHOLD, REVIEW_THRESHOLD
+from transport import get_transport, url_endpoint
+import progress
 
 logger = logging.getLogger(__name__)
 
+# All requests to the BGG API go through this governor
+governor = RateGovernor(name='boardgamegeek.com')
+# Attempts per request when rate limited
+MAX_ATTEMPTS = 5
+
+def bgg_get(url, params):
+    '''
+    Send a GET request to the BGG API through the shared transport and the rate
+    governor. Rate limited requests are retried up to MAX_ATTEMPTS times, other
+    failures are retried by the transport. Returns the last response, or None if
+    no response was received.
+    '''
+    response = None
+    for _ in range(MAX_ATTEMPTS):
+        try:
+            response = governor.call(lambda: get_transport().get(url, params=params), url_endpoint(url))
+        except requests.RequestException as e:
+            logger.error(f"Request to {url} failed: {e}")
+            return None
+        if response.status_code != 429:
+            return response
+        # The governor waits for Retry-After before the next request
+    return response
+
 def clean_name(name):
     # Remove any language tags
     name = re.sub(r'\(.*\)', '', name) # Remove anything in parentheses
     return name.strip()
 
-def get_bgg_id(dl_name):
+def match_search_results(root, dl_name, cleaned_name):
+    '''
+    Pick the BGG ID for a game from the parsed search response. Returns the name,
+    the ID and the confidence of the match between 0 and 1.
+    '''
+    game = root.findall("item")
+
+    # Loop through the results
+    for item in game:
+        # Get the name of the game
+        name = item.find("name").get("value")
+        
+        # Check for exact match and return the ID
+        if name == cleaned_name:
+            logger.info(f"Found exact match for: {cleaned_name}")
+            return dl_name, item.get("id"), 1.0
+    
+    # If exact match not found rank the results by their similarity to the name
+    if game:
+        candidates = NameIndex()
+        for item in game:
+            for name in item.findall("name"):
+                candidates.add(item.get("id"), name.get("value"))
+        match = candidates.match(dl_name)
+        if match is None:
+            logger.info(f"No similar results for: {cleaned_name}, using the first result")
+            return dl_name, game[0].get("id"), 0.0
+        logger.info(f"Found closest match for: {cleaned_name}: {match[2]} ({match[1]})")
+        return dl_name, match[0], match[1]
+    # If no results found return unknown
+    else:
+        logger.info(f"No results found for: {cleaned_name}")
+        return dl_name, "Unknown", None
+
+def get_bgg_id(dl_name, cache=None, index=None):
+    '''
+    Get the BGG ID for a game name. Returns the name, the ID and the confidence
+    of the match. With a NameIndex, names it matches with at least
+    RESOLVE_THRESHOLD confidence are resolved without calling the API.
+    '''
+    if index is not None:
+        match = index.match(dl_name)
+        if match is not None and match[1] >= RESOLVE_THRESHOLD:
+            logger.info(f"Resolved {dl_name} locally as {match[2]} ({match[1]})")
+            return dl_name, match[0], match[1]
+
     # Clean the name
     cleaned_name = clean_name(dl_name)
 
+    # Use the cached search response, or the cached miss, if it hasn't expired
+    if cache is not None:
+        cached, content = cache.lookup_search(cleaned_name)
+        if cached:
+            logger.info(f"Using cached search for game: {dl_name}")
+            if content is None:
+                return dl_name, "Unknown", None
+            return match_search_results(etree.fromstring(content), dl_name, cleaned_name)
+
     url = f"https://boardgamegeek.com/xmlapi2/search?"
     params = {'query': cleaned_name,
               'type': 'boardgame'}
-    response = requests.get(url, params=params)
-
     logger.info(f"Fetching ID for game: {dl_name}")
+    response = bgg_get(url, params)
 
-    if response.status_code == 200:
+    if response is not None and response.status_code == 200:
         # Parse the XML response
         root = etree.fromstring(response.content)
-        game = root.findall("item")
-
-        # Loop through the results
-        for item in game:
-            # Get the name of the game
-            name = item.find("name").get("value")
-            
-            # Check for exact match and return the ID
-            if name == cleaned_name:
-                id = item.get("id")
-                logger.info(f"Found exact match for: {cleaned_name}")
-                return dl_name, item.get("id")
-        
-        # If exact match not found return the first result
-        if game:
-            id = game[0].get("id")
-            logger.info(f"Found closest match for: {cleaned_name}")
-            return dl_name, game[0].get("id")
-        # If no results found return unknown
-        else:
-            logger.info(f"No results found for: {cleaned_name}")
-            return dl_name, "Unknown"
-    if response.status_code == 429:
-        logger.warning(f"Rate limited. Retrying after 10 seconds...")
-        time.sleep(10)
-        return get_bgg_id(dl_name)
+        if cache is not None:
+            cache.store_search(cleaned_name, response.content, found=bool(root.findall("item")))
+        return match_search_results(root, dl_name, cleaned_name)
 
     # If request still fails return null
     else:
         logger.info(f"Failed to fetch ID for: {dl_name}")
-        return dl_name, ''
+        return dl_name, '', None
+
+# The thing endpoint accepts a comma separated list of up to 20 IDs
+DETAILS_BATCH_SIZE = 20
+DETAILS_COLUMNS = ['title', 'id', 'year', 'best_with', 'recommended_with', 'avg_rating', 'no_ratings', 'bgg_rank']
+
+def parse_game_item(item):
+    ''' Extract the details of a game from an <item> of the thing response. '''
+    best_with = item.find(".//poll-summary/result[@name='bestwith']").get("value")
+    recommended_with = item.find(".//poll-summary/result[@name='recommmendedwith']").get("value")
+    title = item.find("name").get("value")
+    year = item.find("yearpublished").get("value")
+    avg_rating = item.find(".//statistics/ratings/average").get("value")
+    no_ratings = item.find(".//statistics/ratings/usersrated").get("value")
+    bgg_rank = item.find(".//statistics/ratings/ranks/rank[@name='boardgame']").get("value")
+    #description = item.find("description").text
+
+    logger.info(f"Title: {title}, Year: {year}, Best with: {best_with}, Reccomended with: {recommended_with}, Avg rating: {avg_rating}, No of ratings: {no_ratings}, bgg_rank: {bgg_rank}")
+
+    return {'title': title,
+            'id': item.get("id"),
+            'year': year,
+            'best_with': best_with,
+            'recommended_with': recommended_with,
+            'avg_rating': avg_rating,
+            'no_ratings': no_ratings,
+            'bgg_rank': bgg_rank}
+
+def parse_game_items(items, game_ids):
+    '''
+    Parse the <item> elements of a thing response. Returns the details of the
+    requested games, with their IDs as they were given, and the IDs not found.
+    '''
+    requested_ids = {str(game_id): game_id for game_id in game_ids}
+    details = []
+    for item in items:
+        try:
+            game = parse_game_item(item)
+        except Exception as e:
+            logger.warning(f"Failed to parse details for game {item.get('id')}: {e}")
+            continue
+        if game['id'] in requested_ids:
+            game['id'] = requested_ids.pop(game['id'])
+            details.append(game)
+    return details, list(requested_ids.values())
+
+def get_game_details_batch(game_ids, cache=None):
+    '''
+    Get the details for several games from the BoardGameGeek API in one request.
+    Returns the details of the games found and the IDs missing from the response.
+
+    With a cache, games with a fresh cached <item> (or a cached miss) are not
+    requested, and the items of the response are stored in the cache.
+    '''
+    cached_items = []
+    cached_ids = []
+    cached_misses = []
+    if cache is not None:
+        ids_to_fetch = []
+        for game_id in game_ids:
+            cached, content = cache.lookup_thing(game_id)
+            if not cached:
+                ids_to_fetch.append(game_id)
+            elif content is None:
+                cached_misses.append(game_id)
+            else:
+                cached_items.append(etree.fromstring(content))
+                cached_ids.append(game_id)
+        if len(ids_to_fetch) < len(game_ids):
+            logger.info(f"Using cached details for {len(game_ids) - len(ids_to_fetch)} games")
+    else:
+        ids_to_fetch = list(game_ids)
+
+    details, missing = parse_game_items(cached_items, cached_ids)
+    if not ids_to_fetch:
+        return details, missing + cached_misses
 
-def get_game_details(game_id):
-    ''' Get the details for a game from the BoardGameGeek API. '''
     url = f"https://boardgamegeek.com/xmlapi2/thing"
-    params = {'id': game_id,
+    params = {'id': ','.join(str(game_id) for game_id in ids_to_fetch),
               'stats': 1}
-    response = requests.get(url, params=params)
-
-    for attempt in range(3):
-        logger.info(f"Fetching details for game: {game_id}")
-
-        if response.status_code == 200:
-            # Parse the XML response
-            root = etree.fromstring(response.content)
-            game = root.find("item")
-            best_with = game.find(".//poll-summary/result[@name='bestwith']").get("value")
-            recommended_with = game.find(".//poll-summary/result[@name='recommmendedwith']").get("value")
-            title = game.find("name").get("value")
-            year = game.find("yearpublished").get("value")
-            avg_rating = game.find(".//statistics/ratings/average").get("value")
-            no_ratings = game.find(".//statistics/ratings/usersrated").get("value")
-            bgg_rank = game.find(".//statistics/ratings/ranks/rank[@name='boardgame']").get("value")
-            #description = game.find("description").text
-            
-            logger.info(f"Title: {title}, Year: {year}, Best with: {best_with}, Reccomended with: {recommended_with}, Avg rating: {avg_rating}, No of ratings: {no_ratings}, bgg_rank: {bgg_rank}")
-
-            return pd.DataFrame({
-                        'title': [title], 
-                        'id': [game_id],
-                        'year': [year], 
-                        'best_with': [best_with], 
-                        'recommended_with': [recommended_with], 
-                        'avg_rating': [avg_rating], 
-                        'no_ratings': [no_ratings], 
-                        'bgg_rank': [bgg_rank]})
-        
-        elif response.status_code == 429 & attempt == 1:  # Rate limit
-                retry_after = int(response.headers.get("Retry-After", 5))  # Default to 2 seconds
-                logger.warning(f"Rate limited. Retrying after {retry_after} seconds...")
-                time.sleep(retry_after)
 
-        elif attempt > 1:
-            logger.error(f"Failed with status {response.status_code}. Retrying...")
-            time.sleep(3 ** attempt)  # Exponential backoff
+    logger.info(f"Fetching details for games: {params['id']}")
+    response = bgg_get(url, params)
 
-def call_bgg_for_id(game_list):
-    id_list = []
-    
-    for game in game_list:
-        name, id = get_bgg_id(game)
-        id_list.append([name, id])
-    return id_list
+    if response is not None and response.status_code == 200:
+        # Parse the XML response
+        items = etree.fromstring(response.content).findall("item")
+        if cache is not None:
+            returned_ids = set()
+            for item in items:
+                returned_ids.add(item.get("id"))
+                cache.store_thing(item.get("id"), etree.tostring(item))
+            # IDs missing from a batch are retried one by one, so only a
+            # single-ID request is cached as a miss
+            if len(ids_to_fetch) == 1 and str(ids_to_fetch[0]) not in returned_ids:
+                cache.store_thing(ids_to_fetch[0], None)
+        fetched_details, fetched_missing = parse_game_items(items, ids_to_fetch)
+        return details + fetched_details, missing + cached_misses + fetched_missing
+
+    logger.error(f"Failed to fetch details for games: {params['id']}")
+    return details, missing + cached_misses + ids_to_fetch
+
+def get_game_details(game_id, cache=None):
+    ''' Get the details for a game from the BoardGameGeek API. '''
+    details, _ = get_game_details_batch([game_id], cache)
+    if details:
+        return pd.DataFrame(details, columns=DETAILS_COLUMNS)
+
+# Number of threads resolving IDs, the governor decides how many requests run at once
+ID_WORKERS = governor.max_concurrency
+
+def call_bgg_for_id(game_list, checkpoint=None, cache=None, index=None):
+    '''
+    Get the BGG IDs for a list of game names, as [name, ID, confidence] lists.
+    The names are resolved by a pool of ID_WORKERS threads, with all requests
+    going through the rate governor.
+
+    With a checkpoint, names resolved by an earlier unfinished run are skipped
+    and every new result is appended to it. With a cache, searches are answered
+    from the BggCache when possible. With a NameIndex, names that match a known
+    BGG title closely enough don't need a search at all. Matches with a
+    confidence below REVIEW_THRESHOLD are logged for review.
+    '''
+    if index is not None:
+        # Build the postings once, before the threads start matching
+        index.build()
 
-def call_bgg_for_details(bgg_data):
-    bgg_enrich = pd.DataFrame(columns=['title', 'year', 'best_with', 'recommended_with', 'avg_rating', 'no_ratings', 'bgg_rank'])
+    def resolve(game):
+        if checkpoint is not None and game in checkpoint.ids:
+            progress.increment('ids_resolved')
+            return [game, *checkpoint.ids[game]]
+        name, id, confidence = get_bgg_id(game, cache, index)
+        if confidence is not None and confidence < REVIEW_THRESHOLD:
+            logger.warning(f"Low confidence match for {name}: {id} ({confidence}), flagged for review")
+        # Failed lookups ('') are not checkpointed so they are tried again
+        if checkpoint is not None and id != '':
+            checkpoint.add_id(name, id, confidence)
+        progress.increment('ids_resolved')
+        return [name, id, confidence]
+
+    with ThreadPoolExecutor(max_workers=ID_WORKERS) as executor:
+        return list(executor.map(resolve, game_list))
+
+def needs_request(game_ids, cache=None):
+    '''
+    Return True if fetching the details of the games sends a request, that is
+    if any of them has no fresh cached item or miss.
+    '''
+    return cache is None or any(not cache.lookup_thing(game_id)[0] for game_id in game_ids)
+
+
+def call_bgg_for_details(bgg_data, checkpoint=None, cache=None, max_requests=None):
+    '''
+    Get the details for all games in bgg_data. The IDs are fetched in batches of
+    DETAILS_BATCH_SIZE, and IDs missing from a batch response are retried one by one.
+    With max_requests at most that many requests are sent, counting the batches
+    and the retries, and the games left are not fetched.
+
+    With a checkpoint, games fetched by an earlier unfinished run are not fetched
+    again and every new result is appended to it. The results are collected in
+    one list per column and turned into a DataFrame at the end. With a cache,
+    details are answered from the BggCache when possible.
+    '''
+    game_ids = [id for id in bgg_data['id'].dropna().drop_duplicates() if str(id).strip()]
+    columns = {column: [] for column in DETAILS_COLUMNS}
+
+    def add(game_details):
+        progress.increment('details_fetched')
+        if checkpoint is not None:
+            checkpoint.add_details(game_details)
+        for column in DETAILS_COLUMNS:
+            columns[column].append(game_details[column])
+
+    # Reuse the details from the checkpoint, keeping the IDs as they were given
+    if checkpoint is not None:
+        ids_to_fetch = []
+        for id in game_ids:
+            if str(id) in checkpoint.details:
+                game_details = dict(checkpoint.details[str(id)], id=id)
+                for column in DETAILS_COLUMNS:
+                    columns[column].append(game_details[column])
+            else:
+                ids_to_fetch.append(id)
+        logger.info(f"Found {len(game_ids) - len(ids_to_fetch)} games in the checkpoint")
+        game_ids = ids_to_fetch
+
+    requests_left = max_requests
+
+    def spend_request(ids):
+        # Games answered from the cache don't cost a request
+        nonlocal requests_left
+        if requests_left is None or not needs_request(ids, cache):
+            return True
+        if requests_left <= 0:
+            return False
+        requests_left -= 1
+        return True
+
+    missing_ids = []
+    for start in range(0, len(game_ids), DETAILS_BATCH_SIZE):
+        batch = game_ids[start:start + DETAILS_BATCH_SIZE]
+        if not spend_request(batch):
+            logger.info(f"Request budget of {max_requests} spent, skipping {len(game_ids) - start} games")
+            break
+        try:
+            batch_details, batch_missing = get_game_details_batch(batch, cache)
+        except Exception as e:
+            logger.exception(f"Failed to fetch details for batch {batch}: {e}")
+            batch_details, batch_missing = [], batch
+        for game_details in batch_details:
+            add(game_details)
+        missing_ids.extend(batch_missing)
 
-    for id in bgg_data['id']:
+    if missing_ids:
+        logger.info(f"Retrying {len(missing_ids)} games missing from the batch responses...")
+    for position, id in enumerate(missing_ids):
+        if not spend_request([id]):
+            logger.info(f"Request budget of {max_requests} spent, not retrying {len(missing_ids) - position} games")
+            break
         try:
-            bgg_enrich = pd.concat([bgg_enrich, get_game_details(id)], ignore_index=True)
+            game_details, _ = get_game_details_batch([id], cache)
         except Exception as e:
+            logger.exception(f"Failed to fetch details for game {id}: {e}")
             continue
-    return bgg_enrich
+        if not game_details:
+            logger.warning(f"No details found for game: {id}")
+        for details in game_details:
+            add(details)
 
+    return pd.DataFrame(columns, columns=DETAILS_COLUMNS)
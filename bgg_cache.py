@@ -0,0 +1,170 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.path.join('output', 'bgg_cache.sqlite')
+
+DAY = 24 * 60 * 60
+# How long a search result or game details are used before asking the API again
+SEARCH_TTL = 30 * DAY
+THING_TTL = 7 * DAY
+# Searches and IDs without results are retried after a backoff that doubles with
+# every miss, up to MAX_MISS_BACKOFF
+MISS_BACKOFF = 1 * DAY
+MAX_MISS_BACKOFF = 30 * DAY
+
+
+def miss_backoff(misses):
+    '''
+    Return how long a lookup is cached after it came back empty misses times in a row.
+    '''
+    return min(MISS_BACKOFF * 2 ** (misses - 1), MAX_MISS_BACKOFF)
+
+
+class BggCache:
+    '''
+    Persistent SQLite cache of the raw BGG API responses.
+
+    Search responses are keyed by the cleaned game name and the <item> of each
+    game from the thing endpoint by its BGG ID. Lookups without results are
+    cached as well, so a known miss is only retried after its backoff.
+    '''
+
+    def __init__(self, path=CACHE_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS search (
+                query TEXT PRIMARY KEY,
+                response BLOB,
+                found INTEGER NOT NULL,
+                misses INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS thing (
+                id TEXT PRIMARY KEY,
+                response BLOB,
+                misses INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        ''')
+
+    def lookup(self, table, key_column, key):
+        '''
+        Return (True, response) if the key has a fresh entry in the table, or
+        (False, None) if the API has to be called. The response is None for a
+        cached miss.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                f'SELECT response, expires_at FROM {table} WHERE {key_column} = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, row[0]
+
+    def store(self, table, key_column, key, response, found, ttl):
+        '''
+        Store a response, or a miss if found is False, with its expiry time.
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                f'SELECT misses FROM {table} WHERE {key_column} = ?', (key,)).fetchone()
+            misses = 0 if found else (row[0] if row else 0) + 1
+            expires_at = now + (ttl if found else miss_backoff(misses))
+            columns = 'response, misses, fetched_at, expires_at'
+            values = [response if found else None, misses, now, expires_at]
+            if table == 'search':
+                columns += ', found'
+                values.append(int(found))
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO {table} ({key_column}, {columns}) VALUES (?, {", ".join("?" * len(values))})',
+                [key, *values])
+            self.writes += 1
+
+    def lookup_search(self, query):
+        return self.lookup('search', 'query', query)
+
+    def store_search(self, query, response, found):
+        self.store('search', 'query', query, response, found, SEARCH_TTL)
+
+    def lookup_thing(self, game_id):
+        return self.lookup('thing', 'id', str(game_id))
+
+    def store_thing(self, game_id, item):
+        '''
+        Store the raw <item> of a game, or a miss if item is None.
+        '''
+        self.store('thing', 'id', str(game_id), item, item is not None, THING_TTL)
+
+    def thing_misses(self):
+        '''
+        Return the IDs with a cached miss that hasn't expired.
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id FROM thing WHERE response IS NULL AND expires_at >= ?', (time.time(),)).fetchall()
+        return {row[0] for row in rows}
+
+    def thing_fetched_at(self, ids):
+        '''
+        Return a dict of ID -> when its cached <item> was fetched, in seconds since
+        the epoch, for the IDs with a cached item.
+        '''
+        fetched_at = {}
+        with self.lock:
+            for game_id in map(str, ids):
+                row = self.connection.execute(
+                    'SELECT fetched_at FROM thing WHERE id = ? AND response IS NOT NULL', (game_id,)).fetchone()
+                if row is not None:
+                    fetched_at[game_id] = row[0]
+        return fetched_at
+
+    def next_expiry(self, queries=(), ids=()):
+        '''
+        Return when the first of the cached searches and games expires, 0 if one of
+        them is not cached, or None if there are no queries or IDs.
+        '''
+        keys = [('search', 'query', query) for query in queries] + [('thing', 'id', str(i)) for i in ids]
+        if not keys:
+            return None
+        expiries = []
+        with self.lock:
+            for table, key_column, key in keys:
+                row = self.connection.execute(
+                    f'SELECT expires_at FROM {table} WHERE {key_column} = ?', (key,)).fetchone()
+                if row is None:
+                    return 0
+                expiries.append(row[0])
+        return min(expiries)
+
+    def version(self):
+        '''
+        Return a value that changes whenever this or another connection writes to the cache.
+        '''
+        with self.lock:
+            return self.writes, self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def iter_responses(self):
+        '''
+        Return the stored search and thing responses, expired or not.
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT response FROM search WHERE response IS NOT NULL '
+                'UNION ALL SELECT response FROM thing WHERE response IS NOT NULL').fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATH = os.path.join('output', 'enrichment_checkpoint.jsonl')
+# Checkpoints older than this are from an abandoned run and are not resumed
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
+
+
+class Checkpoint:
+    '''
+    Append-only file with the BGG IDs and details fetched by the running update.
+
+    Every result is written to the file as soon as it is fetched, so an update
+    that crashes or is interrupted can resume where it stopped. The file is
+    removed with clear() once the update has saved its output.
+    '''
+
+    def __init__(self, path=CHECKPOINT_PATH, max_age=CHECKPOINT_MAX_AGE):
+        self.path = path
+        self.ids = {}      # name -> (BGG ID, match confidence)
+        self.details = {}  # BGG ID -> details
+        self.lock = threading.Lock()
+        self.load(max_age)
+
+    def load(self, max_age):
+        '''
+        Load the results of a previous, unfinished run.
+        '''
+        try:
+            age = time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return
+        if age > max_age:
+            logger.info(f"Ignoring checkpoint from {age / 3600:.0f} hours ago")
+            self.clear()
+            return
+
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # The last line may be cut off by a crash
+                if record.pop('type') == 'id':
+                    self.ids[record['name']] = (record['id'], record.get('confidence'))
+                else:
+                    self.details[str(record['id'])] = record
+
+        logger.info(f"Resuming from checkpoint with {len(self.ids)} IDs and {len(self.details)} game details")
+
+    def append(self, record):
+        '''
+        Append a record to the checkpoint file and flush it to disk.
+        '''
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+    def add_id(self, name, id, confidence=None):
+        self.ids[name] = (id, confidence)
+        self.append({'type': 'id', 'name': name, 'id': id, 'confidence': confidence})
+
+    def add_details(self, details):
+        self.details[str(details['id'])] = details
+        self.append({'type': 'details', **details})
+
+    def clear(self):
+        '''
+        Remove the checkpoint file once its results have been saved.
+        '''
+        with self.lock:
+            self.ids = {}
+            self.details = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
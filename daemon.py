@@ -0,0 +1,84 @@
+import logging
+import random
+import re
+import threading
+from datetime import datetime, time as day_time, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Minutes between updates
+DEFAULT_INTERVAL = 15
+# Up to this many seconds are added to every wait, so the requests of the
+# updates don't line up with the clock
+DEFAULT_JITTER = 60
+
+
+def parse_quiet_hours(value):
+    '''
+    Parse quiet hours such as '23-7' or '23:30-06:45' into a (start, end) pair of
+    times. The period may cross midnight. Returns None for an empty value.
+    '''
+    if not value:
+        return None
+    match = re.fullmatch(r'\s*(\d{1,2})(?::(\d{2}))?\s*-\s*(\d{1,2})(?::(\d{2}))?\s*', value)
+    if not match:
+        raise ValueError(f"Invalid quiet hours '{value}', expected for example '23-7' or '23:30-06:45'")
+    start_hour, start_minute, end_hour, end_minute = match.groups()
+    return (day_time(int(start_hour) % 24, int(start_minute or 0)),
+            day_time(int(end_hour) % 24, int(end_minute or 0)))
+
+
+def quiet_until(moment, quiet_hours):
+    '''
+    Return the end of the quiet hours if moment falls within them, else None.
+    '''
+    if quiet_hours is None:
+        return None
+    start, end = quiet_hours
+    now = moment.time()
+    if start <= end:
+        quiet = start <= now < end
+    else:
+        quiet = now >= start or now < end
+    if not quiet:
+        return None
+    end_moment = datetime.combine(moment.date(), end)
+    return end_moment if end_moment > moment else end_moment + timedelta(days=1)
+
+
+def next_run_time(after, interval, jitter=0, quiet_hours=None):
+    '''
+    Return when the next update should start: interval minutes and a random
+    jitter of up to jitter seconds after `after`, moved to the end of the quiet
+    hours if it falls within them.
+    '''
+    next_run = after + timedelta(minutes=interval, seconds=random.uniform(0, jitter))
+    quiet_end = quiet_until(next_run, quiet_hours)
+    if quiet_end is not None:
+        next_run = quiet_end + timedelta(seconds=random.uniform(0, jitter))
+    return next_run
+
+
+def run_daemon(cycle, interval=DEFAULT_INTERVAL, jitter=DEFAULT_JITTER, quiet_hours=None, stop=None):
+    '''
+    Call cycle every interval minutes until stop is set, skipping the quiet
+    hours. The first cycle runs right away unless it is quiet. A cycle that
+    raises an exception is logged and the daemon carries on, a KeyboardInterrupt
+    stops the daemon.
+    '''
+    stop = stop or threading.Event()
+    now = datetime.now()
+    next_run = quiet_until(now, quiet_hours) or now
+
+    while not stop.is_set():
+        wait = (next_run - datetime.now()).total_seconds()
+        if wait > 0:
+            logger.info(f"Next update at {next_run:%Y-%m-%d %H:%M:%S}")
+            if stop.wait(wait):
+                break
+        try:
+            cycle()
+        except Exception:
+            logger.exception("Update cycle failed, trying again at the next interval")
+        next_run = next_run_time(datetime.now(), interval, jitter, quiet_hours)
+    logger.info("Daemon stopped")
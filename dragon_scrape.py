@@ -1,35 +1,62 @@
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
 import json
+from collections import Counter
 from datetime import datetime
 import logging
+import re
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
+import page_cache
+import progress
+from sources import get_source, all_sources
+from transport import get_transport
 
-os.makedirs('output', exist_ok=True)
+# pandas, BeautifulSoup and the state store are imported where they are used, so
+# scraping and parsing with the 'stream' engine don't pay for importing them
 
 
 logger = logging.getLogger(__name__)
 
-BASE_URL = "https://dragonslair.se/lanebiblioteket/"
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36'
 }
 
+# Number of pages fetched at the same time by scrape_all_pages
+MAX_WORKERS = 4
+# Safety ceiling in case the website never returns an empty page
+MAX_PAGES = 500
+# Pagination links look like '?page=3' or '&page=3'
+PAGE_LINK_PATTERN = re.compile(r'[?&;]page=(\d+)')
+# Send conditional requests and reuse the parsed games of unchanged pages
+USE_PAGE_CACHE = True
+# Engine used by parse_games, see parse_games for the options
+PARSER_ENGINES = ('html.parser', 'strainer', 'stream')
+PARSER_ENGINE = 'stream'
+# Columns of the cleaned games, a game is identified by its source and name
+GAME_COLUMNS = ['source', 'name', 'state']
 
-def fetch_page(page_number):
+
+def request_page(page_number, headers=None, source=None):
     '''
-    Fetch the HTML content of a page from the Dragonslair website.
+    Request a page of a source (by default the library) and return the response.
     '''
+    source = source or get_source()
 
     # Parameters for the request
     params = {
         'page': page_number,
-        'restore_auto_pagination': 'true'
+        **source.params
     }
 
     # Make the request
-    response = requests.get(BASE_URL, headers=HEADERS, params=params)
+    return get_transport().get(source.url, params=params, headers={**HEADERS, **(headers or {})})
+
+
+def fetch_page(page_number, source=None):
+    '''
+    Fetch the HTML content of a page of a source.
+    '''
+    response = request_page(page_number, source=source)
     if response.status_code == 200:
         logger.info(f"Fetched page {page_number}")
         return response.text
@@ -38,111 +65,439 @@ def fetch_page(page_number):
         return None
     
 
-def parse_games(page_content):
+def make_game(product_data, stock_text, source=None):
     '''
-    Parse the HTML content of a page and extract the game data.
+    Create a game from the product data attribute and the stock text of a card.
+    stock_text is None if the card has no stock element. The name and state are
+    cleaned with the rules of the source.
+    '''
+    source = source or get_source()
+    try:
+        product_json = json.loads(product_data)
+        name = product_json.get('name', 'Unknown')
+
+        # Remove unwanted strings from the name
+        for string in source.name_removals:
+            name = name.replace(string, '').strip()
+    except:
+        product_json = None
+        name = "Unknown"
+
+    state = stock_text.strip() if stock_text is not None else "Unknown"
+    state = state.replace('\n', '')
+    for text, replacement in source.state_replacements.items():
+        state = state.replace(text, replacement)
+    state = state.strip()
+
+    return {
+        'name': name,
+        'state': state
+    }
+
+
+def parse_games_soup(soup, source=None):
     '''
-    soup = BeautifulSoup(page_content, 'html.parser')
+    Extract the game data from a BeautifulSoup tree of a page.
+    '''
+    source = source or get_source()
     games = []
     
     # Game elements are in cards on the webpage
-    game_cards = soup.find_all('div', class_='column')
+    game_cards = soup.find_all('div', class_=source.card_class)
     
     for card in game_cards:
-    # Extract the product data (from an attribute)
-        product_data = card.get('data-product-object')
+        # Extract the product data (from an attribute)
+        product_data = card.get(source.product_attribute)
         
         if product_data:
-            try:
-                product_json = json.loads(product_data)
-                name = product_json.get('name', 'Unknown')
-
-                # Remove unwanted strings from the name
-                strings_to_remove = ['-Lånebiblioteket- ', '-Lånebiblioteket -']
-                for string in strings_to_remove:
-                    name = name.replace(string, '').strip()
-            except:
-                product_json = None
-                name = "Unknown"
-            
             # Extract the stock availability (nested tag)
-            stock_span = card.find('div', class_='stock')
-            state = stock_span.text.strip() if stock_span else "Unknown"
-            state = state.replace('\n', '').replace('Finns i lager', 'Available').strip()
-        
-            games.append({
-                    'name': name,
-                    'state': state
-                })
+            stock_span = card.find('div', class_=source.stock_class)
+            games.append(make_game(product_data, stock_span.text if stock_span else None, source))
             
     return games
 
 
-def scrape_all_pages():
+# The text of these tags is not included in the text of an element by BeautifulSoup
+IGNORED_TEXT_TAGS = ('script', 'style', 'template')
+# Tags without content, BeautifulSoup closes them right away and ignores their end tags
+VOID_TAGS = frozenset(['area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame',
+                       'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta',
+                       'nextid', 'param', 'source', 'spacer', 'track', 'wbr'])
+
+
+class ListingParser(HTMLParser):
+    '''
+    Streaming parser that keeps track of the open elements of a page, and
+    collects the product data and stock text of the game cards as it goes.
+
+    Misnested markup is closed like the BeautifulSoup tree of 'html.parser':
+    an end tag closes every element opened after the last open element with
+    its name, and an end tag without an open element is ignored.
+    '''
+
+    def __init__(self, source=None):
+        super().__init__(convert_charrefs=True)
+        self.source = source or get_source()
+        self.cards = []          # [product_data, stock_text] in document order
+        self.open_tags = []      # (tag, card, stock_text) for each open element
+        self.open_counts = Counter()  # number of open elements per tag
+        self.open_stocks = []    # text pieces of each open stock div
+        self.cards_without_stock = []
+        self.open_ignored = 0    # number of open tags whose text is not page text
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        if tag in IGNORED_TEXT_TAGS:
+            self.open_ignored += 1
+        self.open_counts[tag] += 1
+        if tag != 'div':
+            self.open_tags.append((tag, None, None))
+            return
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        card = stock = None
+
+        if self.source.stock_class in classes:
+            # The first stock div inside a card holds its availability
+            stock = []
+            self.open_stocks.append(stock)
+            for waiting_card in self.cards_without_stock:
+                waiting_card[1] = stock
+            self.cards_without_stock = []
+
+        if self.source.card_class in classes:
+            card = [attrs.get(self.source.product_attribute), None]
+            self.cards.append(card)
+            self.cards_without_stock.append(card)
+
+        self.open_tags.append((tag, card, stock))
+
+    def handle_endtag(self, tag):
+        if not self.open_counts[tag]:
+            return
+        while True:
+            open_tag, card, stock = self.open_tags.pop()
+            self.close_element(open_tag, card, stock)
+            if open_tag == tag:
+                break
+
+    def close_element(self, tag, card, stock):
+        self.open_counts[tag] -= 1
+        if tag in IGNORED_TEXT_TAGS:
+            self.open_ignored -= 1
+        if stock is not None:
+            self.open_stocks = [other for other in self.open_stocks if other is not stock]
+        if card is not None:
+            # The card is closed, so a later stock div doesn't belong to it
+            self.cards_without_stock = [other for other in self.cards_without_stock if other is not card]
+
+    def handle_data(self, data):
+        if self.open_ignored:
+            return
+        for stock in self.open_stocks:
+            stock.append(data)
+
+    def unknown_decl(self, data):
+        # CDATA sections are part of the text, like in BeautifulSoup
+        if data.startswith('CDATA['):
+            self.handle_data(data[len('CDATA['):])
+
+
+def parse_games_stream(page_content, source=None):
+    '''
+    Extract the game data from a page with the streaming ListingParser.
+    '''
+    parser = ListingParser(source)
+    parser.feed(page_content)
+    parser.close()
+
+    games = []
+    for product_data, stock in parser.cards:
+        if product_data:
+            games.append(make_game(product_data, ''.join(stock) if stock is not None else None, parser.source))
+    return games
+
+
+def parse_games(page_content, engine=None, source=None):
+    '''
+    Parse the HTML content of a page and extract the game data.
+
+    The engine can be one of PARSER_ENGINES. All engines return the same games:
+    'html.parser' builds the full BeautifulSoup tree, 'strainer' only builds the
+    tree of the game cards and 'stream' reads the page with a streaming parser
+    without building a tree. Defaults to the engine of the source, or PARSER_ENGINE.
+    The cards are found and cleaned with the parser config of the source.
+    '''
+    source = source or get_source()
+    engine = engine or source.engine or PARSER_ENGINE
+    if engine in ('html.parser', 'strainer'):
+        from bs4 import BeautifulSoup, SoupStrainer
+    if engine == 'html.parser':
+        return parse_games_soup(BeautifulSoup(page_content, 'html.parser'), source)
+    elif engine == 'strainer':
+        # Only keep the divs with product data, the game cards are in or below them
+        only_cards = SoupStrainer('div', attrs={source.product_attribute: True})
+        return parse_games_soup(BeautifulSoup(page_content, 'html.parser', parse_only=only_cards), source)
+    elif engine == 'stream':
+        return parse_games_stream(page_content, source)
+    else:
+        raise ValueError(f"Unknown parser engine: {engine}. Use one of {PARSER_ENGINES}")
+
+
+def parser_fingerprint(source, engine=None):
+    '''
+    Return a fingerprint of the parser engine and the parser and name-cleaning
+    config of a source, everything that decides the games parsed from a page.
+    '''
+    config = [engine or source.engine or PARSER_ENGINE, source.card_class, source.stock_class,
+              source.product_attribute, list(source.name_removals), sorted(source.state_replacements.items())]
+    return page_cache.content_hash(json.dumps(config, ensure_ascii=False))
+
+
+def find_page_count(page_content):
+    '''
+    Find the highest page number linked from the pagination of a page.
+    Returns None if the page has no pagination links.
+    '''
+    page_numbers = [int(number) for number in PAGE_LINK_PATTERN.findall(page_content)]
+    return max(page_numbers) if page_numbers else None
+
+
+def fetch_and_parse_page(page_number, use_cache=USE_PAGE_CACHE, source=None):
+    '''
+    Fetch a page and parse the games on it. Returns the games and the page count
+    found in the pagination, or (None, None) if the request fails.
+
+    With use_cache the request is sent with the ETag/Last-Modified of the previous
+    run, and the cached games are reused if the page is not modified or its
+    content hash is unchanged. Every source has its own directory in the cache.
+    Cached games parsed with another engine or parser config are not reused.
+    '''
+    source = source or get_source()
+    cache_dir = os.path.join(page_cache.CACHE_DIR, source.key)
+    logger.info(f"Fetching page {page_number} of {source.key}...")
+    fingerprint = parser_fingerprint(source)
+    entry = page_cache.load_entry(page_number, cache_dir) if use_cache else None
+    if entry and entry.get('parser') != fingerprint:
+        # Without the conditional headers the page is sent again and parsed anew
+        logger.info(f"Page {page_number} of {source.key} was cached by another parser config, fetching it again")
+        entry = None
+    response = request_page(page_number, page_cache.conditional_headers(entry), source)
+
+    if response.status_code == 304 and entry:
+        logger.info(f"Page {page_number} of {source.key} not modified, using cached games")
+        progress.increment('pages_fetched')
+        return entry['games'], entry['page_count']
+    if response.status_code != 200:
+        logger.warning(f"Failed to fetch page {page_number} of {source.key}. Status code: {response.status_code}")
+        return None, None
+
+    logger.info(f"Fetched page {page_number} of {source.key}")
+    progress.increment('pages_fetched')
+    page_hash = page_cache.content_hash(response.text)
+    if entry and entry['hash'] == page_hash:
+        logger.info(f"Page {page_number} of {source.key} unchanged, using cached games")
+        games, page_count = entry['games'], entry['page_count']
+    else:
+        games, page_count = parse_games(response.text, source=source), find_page_count(response.text)
+
+    if use_cache:
+        page_cache.save_entry(page_number, page_cache.make_entry(response, page_hash, games, page_count, fingerprint), cache_dir)
+    return games, page_count
+
+
+def collect_games(pages):
     '''
-    Scrape all pages of the Dragonslair website and return a list of all games.
+    Combine the games of consecutive pages, starting at page 1, and stop at the
+    first page that failed, was empty or repeats the previous page.
     '''
     all_games = []
+    previous_games = None
     page_number = 1
 
-    # Loop through all pages until no more games are found
-    while page_number < 20:
-        logger.info(f"Fetching page {page_number}...")
-        page_content = fetch_page(page_number)
-        if not page_content:
+    while page_number in pages:
+        games = pages[page_number]
+        if games is None:
             break  # Stop if request fails
-        
-        games = parse_games(page_content)
         if not games:
             logger.warning("No more games found. Stopping.")
             break  # Stop if no more games are found on the page
-        
+        if games == previous_games:
+            logger.warning(f"Page {page_number} repeats the previous page. Stopping.")
+            break  # Some listings return the last page again when going past the end
+
         all_games.extend(games)
+        previous_games = games
         page_number += 1
-        
+
     return all_games
 
-def clean_data(all_games):
+
+def scrape_all_pages(max_workers=MAX_WORKERS, use_cache=USE_PAGE_CACHE, source=None):
+    '''
+    Scrape all pages of a source (by default the library) and return a list of all games.
+
+    Pages are fetched and parsed by a pool of max_workers threads. The number of
+    pages is read from the pagination of the first page, and pages beyond it are
+    probed until a page fails or comes back empty. With max_workers=1 the pages
+    are fetched one at a time. See fetch_and_parse_page for use_cache.
+    '''
+    source = source or get_source()
+    if max_workers <= 1:
+        return scrape_pages_sequentially(use_cache, source)
+
+    # The first page tells us how many pages to expect
+    first_games, page_count = fetch_and_parse_page(1, use_cache, source)
+    if not first_games:
+        logger.warning(f"No games found on the first page of {source.key}.")
+        return []
+    pages = {1: first_games}
+
+    page_count = page_count or 1
+    logger.info(f"Found {page_count} pages in the pagination of {source.key}. Fetching with {max_workers} workers...")
+
+    next_page = 2
+    end_page = None  # The first page that failed or was empty
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Queue the known pages and keep probing past them until the end is found
+            while (end_page is None and next_page <= MAX_PAGES
+                   and (next_page <= page_count or len(pending) < max_workers)):
+                pending[executor.submit(fetch_and_parse_page, next_page, use_cache, source)] = next_page
+                next_page += 1
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page_number = pending.pop(future)
+                games = pages[page_number] = future.result()[0]
+                if not games:
+                    last_page = page_number
+                elif games == pages.get(page_number - 1):
+                    last_page = page_number
+                elif games == pages.get(page_number + 1):
+                    last_page = page_number + 1
+                else:
+                    continue
+                if end_page is None or last_page < end_page:
+                    end_page = last_page
+
+            # Drop queued pages past the end, the running ones are left to finish
+            for future in [f for f, number in pending.items() if end_page is not None and number > end_page]:
+                if future.cancel():
+                    del pending[future]
+
+    return collect_games(pages)
+
+
+def scrape_pages_sequentially(use_cache=USE_PAGE_CACHE, source=None):
     '''
-    Clean the list of games and convert it to a DataFrame.
+    Scrape the pages one at a time, stopping at the first failed or empty page.
     '''
-    # Convert the list of games to a DataFrame
-    df = pd.DataFrame(all_games)
-    # Replace the state values to be consistently in English
-    df.loc[df['state'] == 'Beställningsvara', 'state'] = 'Unavailable'
-    df.loc[df['state'] == 'Slut i lager', 'state'] = 'Unavailable'
-    # Remove any games with the name 'Unknown'
-    df = df[df['name'] != 'Unknown'].reset_index(drop=True)
-    # Replace commas with semicolons in the game names
-    df['name'] = df['name'].str.replace(',', ';')
+    source = source or get_source()
+    pages = {}
+    page_number = 1
+
+    # Loop through all pages until no more games are found
+    while page_number <= MAX_PAGES:
+        pages[page_number], _ = fetch_and_parse_page(page_number, use_cache, source)
+        if not pages[page_number] or pages[page_number] == pages.get(page_number - 1):
+            break
+        page_number += 1
 
-    return df
+    return collect_games(pages)
 
 
-def generate_output(new_run):
+def scrape_sources(sources=None, max_workers=MAX_WORKERS, use_cache=USE_PAGE_CACHE):
+    '''
+    Scrape several sources at the same time, by default all registered sources,
+    and return a dict of source key -> games. Each source is scraped with
+    scrape_all_pages and max_workers page workers, over the shared connection
+    pool of the transport. A source that fails gets an empty list of games.
+    '''
+    sources = list(sources or all_sources())
+    # Every source runs max_workers requests to the same host at the same time
+    get_transport().ensure_pool_size(len(sources) * max_workers)
+    if len(sources) == 1:
+        return {sources[0].key: scrape_all_pages(max_workers, use_cache, sources[0])}
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {executor.submit(scrape_all_pages, max_workers, use_cache, source): source for source in sources}
+        for future, source in futures.items():
+            try:
+                results[source.key] = future.result()
+            except Exception:
+                logger.exception(f"Scraping {source.key} failed")
+                results[source.key] = []
+    logger.info("Scraped " + ', '.join(f'{key}: {len(games)} games' for key, games in results.items()))
+    return results
+
+
+def clean_games(all_games, source=None):
+    '''
+    Clean the list of games of a source: the states are consistently in English,
+    games named 'Unknown' are removed and commas in the names are replaced with
+    semicolons. Every game gets the key of its source.
+    '''
+    source = source or get_source()
+    return [{'source': source.key,
+             'name': game['name'].replace(',', ';') if isinstance(game['name'], str) else game['name'],
+             'state': 'Unavailable' if game['state'] in source.unavailable_states else game['state']}
+            for game in all_games if game['name'] != 'Unknown']
+
+
+def clean_data(all_games, source=None):
+    '''
+    Clean the list of games of a source and convert it to a DataFrame.
+    '''
+    import pandas as pd
+    return pd.DataFrame(clean_games(all_games, source), columns=GAME_COLUMNS)
+
+
+def generate_output(new_run, previous_state=None):
     '''
     Generate the output files and compare the new run with the previous run.
+    The previous run is loaded from the state store unless previous_state is given.
+
+    Games are compared by source and name. The games of sources that have no
+    games in the new run, because they failed or weren't scraped, are kept as
+    they were with the status 'No Change'.
     '''
-    # Load the previous run
-    try:
-        previous_run = pd.read_csv('output/final_data.csv')
-        previous_run = previous_run[['name', 'state_current', 'state_previous' , 'state_since', 'status']]
-    except FileNotFoundError:
-        # If the file doesn't exist, create an empty DataFrame
-        previous_run = pd.DataFrame(columns=['name', 'state_current', 'state_previous' , 'state_since', 'status'])
+    import pandas as pd
+    from state_store import load_state, coerce_types
+
+    # Load the previous run, only the columns needed for the comparison
+    columns = ['source', 'name', 'state_current', 'state_previous' , 'state_since', 'status']
+    previous_run = load_state(columns=columns) if previous_state is None else previous_state[columns]
+    previous_run = previous_run.astype({'source': object, 'name': object, 'state_current': object})
+
+    # Keep the partitions of the sources that are not in the new run
+    scraped = previous_run['source'].isin(new_run['source'].unique())
+    kept = previous_run.loc[~scraped].assign(status='No Change')
+    if len(kept):
+        logger.info(f"Keeping {len(kept)} games of sources without games in this run: "
+                    f"{', '.join(kept['source'].unique())}")
+    previous_run = previous_run.loc[scraped]
 
     # Rename the columns for the comparison
     previous_run = previous_run.rename(columns={'state_current': 'state'})
     previous_run.drop(columns=['state_previous'], inplace=True)
 
     # Merge the previous and new runs for comparison
-    comparison = pd.merge(previous_run, new_run, on='name', how='outer', suffixes=('_previous', '_current'))
+    comparison = pd.merge(previous_run, new_run, on=['source', 'name'], how='outer', suffixes=('_previous', '_current'))
 
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    current_time = pd.Timestamp(datetime.now().replace(microsecond=0))
 
     # Update the 'status' column based on the state changes
     comparison['status'] = 'No Change'
-    comparison.loc[comparison['state_previous'] != comparison['state_current'], 'status'] = 'State Change'
+    both_missing = comparison['state_previous'].isna() & comparison['state_current'].isna()
+    comparison.loc[(comparison['state_previous'] != comparison['state_current']) & ~both_missing, 'status'] = 'State Change'
     comparison.loc[comparison['state_previous'].isna() & ~comparison['state_current'].isna(), 'status'] = 'New Game'
     comparison.loc[~comparison['state_previous'].isna() & comparison['state_current'].isna(), 'status'] = 'Removed'
 
@@ -150,8 +505,9 @@ def generate_output(new_run):
     comparison.loc[comparison['state_since'].isna(), 'state_since'] = current_time
     comparison.loc[comparison['status'] == 'State Change', 'state_since'] = current_time
 
-    # Reorder the columns
-    comparison = comparison[['name', 'state_previous', 'state_current', 'state_since', 'status']]
+    # Reorder the columns and add the kept partitions back
+    comparison = comparison[['source', 'name', 'state_previous', 'state_current', 'state_since', 'status']]
+    comparison = coerce_types(pd.concat([comparison, kept[comparison.columns]], ignore_index=True) if len(kept) else comparison)
 
     # Save the new run
     differences = comparison[(comparison['status'] == 'State Change') | (comparison['status'] == 'New Game')]
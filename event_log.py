@@ -0,0 +1,293 @@
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from state_store import OUTPUT_DIR
+from sources import DEFAULT_SOURCE
+
+logger = logging.getLogger(__name__)
+
+EVENT_LOG_PATH = os.path.join(OUTPUT_DIR, 'events.sqlite')
+EVENT_STATUSES = ('State Change', 'New Game', 'Removed')
+# Take a new snapshot of the current state after this many events
+COMPACT_EVERY = 1000
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# user_version of an event log with a snapshot of every game, see connect
+SEEDED_VERSION = 1
+
+
+def connect(path=EVENT_LOG_PATH):
+    '''
+    Open the event log, creating the tables and indexes if needed.
+
+    events holds every availability transition. A snapshot stores the state of
+    every game after the event with rowid last_event, so the current state can
+    be rebuilt from the latest snapshot and the events after it. Games are
+    identified by their source and name.
+
+    The first append writes a snapshot of every game of the run, so games that
+    were in their state before the log was started are in the log too. The
+    user_version of the database is SEEDED_VERSION once that snapshot exists.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path)
+    add_source_column(connection)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS events (
+            ts TEXT NOT NULL,
+            source TEXT NOT NULL,
+            name TEXT NOT NULL,
+            event TEXT NOT NULL,
+            state_previous TEXT,
+            state_current TEXT
+        );
+        CREATE INDEX IF NOT EXISTS events_source_name_ts ON events (source, name, ts);
+        CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            ts TEXT NOT NULL,
+            last_event INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_states (
+            snapshot_id INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            name TEXT NOT NULL,
+            state TEXT,
+            since TEXT NOT NULL,
+            PRIMARY KEY (snapshot_id, source, name)
+        );
+    ''')
+    return connection
+
+
+def add_source_column(connection):
+    '''
+    Add the source to an event log written before there were several sources.
+    Its events belong to the default source. The snapshots are dropped, as
+    they are keyed by name only, and rebuilt from the events at the next compaction.
+    '''
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(events)')]
+    if not columns or 'source' in columns:
+        return
+    with connection:
+        connection.execute(f"ALTER TABLE events ADD COLUMN source TEXT NOT NULL DEFAULT '{DEFAULT_SOURCE}'")
+        connection.execute('DROP INDEX IF EXISTS events_name_ts')
+        connection.execute('DROP TABLE IF EXISTS snapshot_states')
+        connection.execute('DROP TABLE IF EXISTS snapshots')
+    logger.info("Added the source to the event log")
+
+
+def is_seeded(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0] >= SEEDED_VERSION
+
+
+def log_seeded(path=EVENT_LOG_PATH):
+    '''
+    Return True if the event log has a snapshot of every game. Until it has,
+    every run should be appended, even one without transitions.
+    '''
+    connection = connect(path)
+    try:
+        return is_seeded(connection)
+    finally:
+        connection.close()
+
+
+def append_events(comparison, ts=None, path=EVENT_LOG_PATH):
+    '''
+    Append the transitions of a run (the comparison from generate_output) to the
+    event log, and compact the log when enough events have been added.
+    Returns the number of events appended.
+
+    The first append also writes a snapshot of every game of the comparison
+    with its current state and state_since, as the log only records changes.
+    '''
+    ts = (ts or datetime.now()).strftime(TIME_FORMAT)
+    events = comparison.loc[comparison['status'].isin(EVENT_STATUSES)]
+    sources = events['source'] if 'source' in events.columns else [DEFAULT_SOURCE] * len(events)
+    rows = [(ts, source, name, status,
+             None if pd.isna(previous) else str(previous),
+             None if pd.isna(current) else str(current))
+            for source, name, status, previous, current in zip(sources, events['name'], events['status'],
+                                                               events['state_previous'], events['state_current'])]
+
+    connection = connect(path)
+    try:
+        with connection:
+            connection.executemany(
+                'INSERT INTO events (ts, source, name, event, state_previous, state_current) VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+        if not is_seeded(connection):
+            seed(connection, comparison, ts)
+        elif events_since_snapshot(connection) >= COMPACT_EVERY:
+            compact(connection)
+    finally:
+        connection.close()
+
+    logger.info(f"Appended {len(rows)} events to the event log")
+    return len(rows)
+
+
+def latest_snapshot(connection):
+    '''
+    Return the (id, last_event) of the latest snapshot, or (None, 0) if there is none.
+    '''
+    row = connection.execute('SELECT id, last_event FROM snapshots ORDER BY id DESC LIMIT 1').fetchone()
+    return row if row else (None, 0)
+
+
+def events_since_snapshot(connection):
+    _, last_event = latest_snapshot(connection)
+    return connection.execute('SELECT COUNT(*) FROM events WHERE rowid > ?', (last_event,)).fetchone()[0]
+
+
+def replay(connection):
+    '''
+    Rebuild the current state from the latest snapshot and the events after it.
+    Returns a dict of (source, name) -> (state, since).
+    '''
+    snapshot_id, last_event = latest_snapshot(connection)
+    states = {}
+    if snapshot_id is not None:
+        for source, name, state, since in connection.execute(
+                'SELECT source, name, state, since FROM snapshot_states WHERE snapshot_id = ?', (snapshot_id,)):
+            states[source, name] = (state, since)
+    for ts, source, name, state in connection.execute(
+            'SELECT ts, source, name, state_current FROM events WHERE rowid > ? ORDER BY rowid', (last_event,)):
+        states[source, name] = (state, ts)
+    return states
+
+
+def seed(connection, comparison, ts):
+    '''
+    Write a snapshot of every game of the comparison, the state after its
+    transitions were appended, and mark the log as seeded.
+    '''
+    sources = comparison['source'] if 'source' in comparison.columns else [DEFAULT_SOURCE] * len(comparison)
+    states = {(source, name): (None if pd.isna(state) else str(state),
+                               ts if pd.isna(since) else pd.Timestamp(since).strftime(TIME_FORMAT))
+              for source, name, state, since in zip(sources, comparison['name'], comparison['state_current'],
+                                                    comparison['state_since'])}
+    write_snapshot(connection, states)
+    connection.execute(f'PRAGMA user_version = {SEEDED_VERSION}')
+    logger.info(f"Seeded the event log with a snapshot of {len(states)} games")
+
+
+def compact(connection):
+    '''
+    Write a snapshot of the current state and drop the older snapshots. The
+    events are kept for the history queries.
+    '''
+    states = replay(connection)
+    write_snapshot(connection, states)
+    logger.info(f"Compacted the event log into a snapshot of {len(states)} games")
+
+
+def write_snapshot(connection, states):
+    '''
+    Write a snapshot of the states, a dict of (source, name) -> (state, since),
+    after the last event and drop the older snapshots.
+    '''
+    last_event = connection.execute('SELECT COALESCE(MAX(rowid), 0) FROM events').fetchone()[0]
+    with connection:
+        cursor = connection.execute('INSERT INTO snapshots (ts, last_event) VALUES (?, ?)',
+                                    (datetime.now().strftime(TIME_FORMAT), last_event))
+        snapshot_id = cursor.lastrowid
+        connection.executemany(
+            'INSERT INTO snapshot_states (snapshot_id, source, name, state, since) VALUES (?, ?, ?, ?, ?)',
+            [(snapshot_id, source, name, state, since) for (source, name), (state, since) in states.items()])
+        connection.execute('DELETE FROM snapshot_states WHERE snapshot_id < ?', (snapshot_id,))
+        connection.execute('DELETE FROM snapshots WHERE id < ?', (snapshot_id,))
+
+
+def current_state(path=EVENT_LOG_PATH):
+    '''
+    Return the current state of every game according to the event log, as a
+    DataFrame with the columns source, name, state and since. Removed games have no state.
+    '''
+    connection = connect(path)
+    try:
+        states = replay(connection)
+    finally:
+        connection.close()
+    df = pd.DataFrame([(source, name, state, since) for (source, name), (state, since) in states.items()],
+                      columns=['source', 'name', 'state', 'since'])
+    df['since'] = pd.to_datetime(df['since'])
+    return df
+
+
+def game_timeline(name, source=DEFAULT_SOURCE, path=EVENT_LOG_PATH):
+    '''
+    Return all events of a game of a source in time order.
+    '''
+    connection = connect(path)
+    try:
+        df = pd.read_sql_query(
+            'SELECT ts, event, state_previous, state_current FROM events WHERE source = ? AND name = ? '
+            'ORDER BY ts, rowid', connection, params=(source, name))
+    finally:
+        connection.close()
+    df['ts'] = pd.to_datetime(df['ts'])
+    return df
+
+
+def availability_fraction(days=30, now=None, path=EVENT_LOG_PATH):
+    '''
+    Return the fraction of the last `days` days that each game was available,
+    counted over the time the game was in the library during the window. A game
+    without any event is in the state of the latest snapshot for the whole
+    window, or since it got that state if that was later.
+    Returns a DataFrame with the columns source, name and available_fraction.
+    '''
+    now = now or datetime.now()
+    start = now - timedelta(days=days)
+    start_ts = start.strftime(TIME_FORMAT)
+
+    connection = connect(path)
+    try:
+        # The state at the start of the window is the last event before it
+        # (SQLite returns the row of MAX(ts) for the bare columns)
+        before = pd.read_sql_query(
+            'SELECT source, name, MAX(ts) AS ts, state_current FROM events WHERE ts < ? GROUP BY source, name',
+            connection, params=(start_ts,))
+        during = pd.read_sql_query(
+            'SELECT source, name, ts, state_previous, state_current FROM events WHERE ts >= ? '
+            'ORDER BY source, name, ts, rowid',
+            connection, params=(start_ts,))
+        # Games that never changed since the log was seeded
+        snapshot_id, _ = latest_snapshot(connection)
+        unchanged = pd.read_sql_query(
+            'SELECT source, name, MAX(since, ?) AS ts, state AS state_current FROM snapshot_states AS s '
+            'WHERE snapshot_id = ? AND state IS NOT NULL AND NOT EXISTS '
+            '(SELECT 1 FROM events AS e WHERE e.source = s.source AND e.name = s.name)',
+            connection, params=(start_ts, snapshot_id))
+    finally:
+        connection.close()
+
+    before['ts'] = start_ts
+    # A game without an event before the window was in the previous state of its
+    # first event in the window since the start of the window, unless it was new.
+    # This covers the time before the log was started, as only changes are logged
+    first = during.drop_duplicates(subset=['source', 'name']).merge(
+        before[['source', 'name']], how='left', on=['source', 'name'], indicator=True)
+    earlier = (first.loc[(first['_merge'] == 'left_only') & first['state_previous'].notna(),
+                         ['source', 'name', 'state_previous']]
+               .rename(columns={'state_previous': 'state_current'}).assign(ts=start_ts))
+    intervals = pd.concat([unchanged, before, earlier, during.drop(columns='state_previous')], ignore_index=True)
+    if intervals.empty:
+        return pd.DataFrame(columns=['source', 'name', 'available_fraction'])
+    intervals['ts'] = pd.to_datetime(intervals['ts'])
+    intervals = intervals.sort_values(['source', 'name', 'ts'], kind='stable')
+
+    # Every event lasts until the next event of the same game, or until now
+    intervals['until'] = intervals.groupby(['source', 'name'])['ts'].shift(-1).fillna(pd.Timestamp(now))
+    # Time after a game was removed doesn't count
+    intervals['seconds'] = (intervals['until'] - intervals['ts']).dt.total_seconds().where(intervals['state_current'].notna(), 0)
+    intervals['available_seconds'] = intervals['seconds'].where(intervals['state_current'] == 'Available', 0)
+
+    totals = intervals.groupby(['source', 'name'])[['seconds', 'available_seconds']].sum()
+    fraction = (totals['available_seconds'] / totals['seconds'].where(totals['seconds'] > 0)).fillna(0)
+    return fraction.rename('available_fraction').reset_index()
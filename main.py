@@ -1,8 +1,21 @@
-import pandas as pd
 import logging
 import os
-from dragon_scrape import scrape_all_pages, clean_data, generate_output
-from bgg_api import call_bgg_for_id, call_bgg_for_details
+import argparse
+import signal
+import sys
+import threading
+import time
+from bgg_cache import BggCache
+from output_files import state_version
+from state_digest import availability_hash, state_unchanged, write_digest
+from update_job import CANCEL_SIGNAL, UpdateLock, UpdateRunning, UpdateCancelled
+from daemon import DEFAULT_INTERVAL, DEFAULT_JITTER, parse_quiet_hours, run_daemon
+import progress
+import metrics
+
+# pandas, requests and the modules that use them are imported by run_update when
+# it needs them, so the command line starts fast and an update that finds no
+# changes never imports pandas. benchmarks/bench_startup.py checks the budget.
 
 # Get the directory of the script and set it as the working directory
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,43 +33,138 @@ logging.basicConfig(filename=log_file,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S')
 
-if __name__ == '__main__':
+class UpdateContext:
+    '''
+    What an update can reuse from the previous update in the same process: the
+    saved state, the BGG cache and the name index. A single run uses a fresh
+    context, the daemon keeps one for its lifetime so every cycle starts warm.
+
+    refresh_budget is the number of BGG requests an update may spend on
+    refreshing stale statistics, None for the default of refresh.REFRESH_BUDGET.
+    '''
+
+    def __init__(self, csv_export=True, refresh_budget=None):
+        self.csv_export = csv_export
+        self.refresh_budget = refresh_budget
+        self.state = None
+        self.state_version = None
+        self.bgg_cache = None
+        self.name_index = None
+        self.index_version = None
+
+    def previous_state(self):
+        # Reload the state if another process, like an update started from the app, wrote it
+        from state_store import load_state
+        version = state_version()
+        if self.state is None or version != self.state_version:
+            self.state = load_state()
+            self.state_version = version
+        return self.state
+
+    def saved_state(self, state):
+        self.state = state
+        self.state_version = state_version()
+
+    def cache(self):
+        if self.bgg_cache is None:
+            self.bgg_cache = BggCache()
+        return self.bgg_cache
+
+    def index(self):
+        # Rebuild the name index only when responses were added to the cache
+        from name_index import NameIndex
+        version = self.cache().version()
+        if self.name_index is None or version != self.index_version:
+            self.name_index = NameIndex.from_cache(self.cache())
+            self.index_version = version
+        return self.name_index
+
+
+def run_update(context=None, force=False, sources=None):
+    '''
+    Scrape the sources (by default all registered sources), compare them with
+    the previous run, enrich new games with BGG data and save the output. The
+    state is only written when it changed.
+
+    If the availability is the same as in the saved state, no game changed its
+    status in the last update and no BGG lookup or refresh is due, the update
+    stops after the scrape and leaves the output as it is, unless force is True.
+    '''
+    from dragon_scrape import GAME_COLUMNS, scrape_sources, clean_games
+    from sources import get_source
+
+    context = context or UpdateContext()
     logger.info('Starting the scraping process...')
-    # Scrape the Dragon's Lair website
-    scrape_results = scrape_all_pages()
-    output, updates = generate_output(clean_data(scrape_results))
+    # Scrape the listings, all sources at the same time
+    progress.stage('scrape')
+    with metrics.stage('scrape'):
+        scrape_results = scrape_sources(sources)
+    with metrics.stage('check'):
+        games = [game for key, source_games in scrape_results.items()
+                 for game in clean_games(source_games, get_source(key))]
+        availability = availability_hash(games)
+        unchanged = not force and state_unchanged(availability, refresh=context.refresh_budget != 0)
+    if unchanged:
+        metrics.count('games', len(games))
+        logger.info("No availability changes and no BGG lookups due, the state is up to date.")
+        print("No changes.")
+        return
+
+    import pandas as pd
+    from dragon_scrape import generate_output
+    from bgg_api import call_bgg_for_id, call_bgg_for_details, clean_name
+    from checkpoint import Checkpoint
+    from state_store import STATUSES, save_state, coerce_types, states_equal
+    from event_log import EVENT_STATUSES, append_events, log_seeded
+    from annotations import ensure_store, join_annotations
+    from refresh import REFRESH_BUDGET, select_refresh, next_refresh_at
+
+    with metrics.stage('clean'):
+        new_run = pd.DataFrame(games, columns=GAME_COLUMNS)
+    with metrics.stage('load'):
+        # The previous state, empty on the first run
+        prev_final_data = context.previous_state()
+    with metrics.stage('diff'):
+        output, updates = generate_output(new_run, prev_final_data)
     logger.info('Scraping complete.')
-    logger.info(f'Stock availability updates: {updates}')
-
-    # Check if this is the first run
-    final_data_path = os.path.join(output_dir, 'final_data.csv')
-    first_run = not os.path.exists(final_data_path)
-
-    # if first run, only get IDs for new games
-    if first_run:
-        games_to_fetch = output.loc[output['status'] == 'New Game']['name']
-        # Create empty DataFrames to avoid errors
-        prev_id_data = pd.DataFrame(columns=['id', 'name'])
-        prev_bgg_enriched_data = pd.DataFrame(columns=['id'])
-        prev_final_data = output
-        
-    else:
-        # If not first run, get IDs for new games and games with unknown IDs
-        prev_final_data = pd.read_csv(final_data_path) 
-        prev_id_data = prev_final_data[['id', 'name']]
-        prev_bgg_enriched_data = prev_final_data[['title','year','best_with','recommended_with','avg_rating','no_ratings','bgg_rank','id']]
-
-        # Get the games to fetch
-        new_games = output.loc[output['status'] == 'New Game']['name']
-        unfetched_games = prev_final_data.loc[prev_final_data['id'] == 'Unknown']['name']
+
+    # Log a summary of the changes, the changed games are in the event log
+    status_counts = output['status'].value_counts()
+    for status in STATUSES:
+        metrics.count(status.lower().replace(' ', '_'), int(status_counts.get(status, 0)))
+    metrics.count('games', len(output))
+    logger.info(f"Stock availability updates: {len(updates)} "
+                f"({', '.join(f'{status}: {count}' for status, count in status_counts.items())})")
+
+    with metrics.stage('load'):
+        # The BGG data is per name and ID, a game listed by several sources is looked up once
+        prev_id_data = prev_final_data[['id', 'name', 'match_confidence']].drop_duplicates(subset=['name'], keep='last')
+        prev_bgg_enriched_data = prev_final_data.loc[prev_final_data['title'].notna(), ['title','year','best_with','recommended_with','avg_rating','no_ratings','bgg_rank','bgg_fetched_at','id']].drop_duplicates(subset=['id'], keep='last')
+
+        # Get IDs for new games and games without an ID, new games of a source
+        # are only looked up if no other source has them
+        known_names = prev_id_data.loc[prev_id_data['id'].notna(), 'name']
+        new_games = output.loc[(output['status'] == 'New Game') & ~output['name'].isin(known_names), 'name']
+        unfetched_games = prev_final_data.loc[prev_final_data['id'].isna()]['name']
         games_to_fetch = pd.concat([new_games, unfetched_games], ignore_index=True).drop_duplicates().tolist()
 
+        # Results fetched from the BGG API are checkpointed until the output is saved
+        checkpoint = Checkpoint()
+        # Raw BGG responses, including misses, are cached between runs
+        bgg_cache = context.cache()
+        # Names that closely match a BGG title seen before are resolved without a search
+        name_index = context.index()
+
     # Get the IDs for the games
+    metrics.count('ids_to_fetch', len(games_to_fetch))
     if games_to_fetch:
         #ids_to_get = games_to_fetch.tolist()
         logger.info(f"Fetching IDs for {len(games_to_fetch)} games...")
-        id_output = pd.DataFrame(call_bgg_for_id(games_to_fetch), columns=['name', 'id'])
-        updated_bgg_data = pd.concat([prev_id_data, id_output]).drop_duplicates(subset=['name'], keep='last')
+        progress.stage('ids', ids_total=len(games_to_fetch))
+        with metrics.stage('ids'):
+            id_output = coerce_types(pd.DataFrame(call_bgg_for_id(games_to_fetch, checkpoint, bgg_cache, name_index),
+                                                  columns=['name', 'id', 'match_confidence']))
+            updated_bgg_data = pd.concat([prev_id_data, id_output]).drop_duplicates(subset=['name'], keep='last')
     else:
         print("No new games to fetch.")
         updated_bgg_data = prev_id_data
@@ -64,31 +172,179 @@ if __name__ == '__main__':
 
     # Get the details for the games
     ## only run for games that have an ID and are not in the previous enriched data
-    games_to_enrich = updated_bgg_data.loc[(updated_bgg_data['id'] != 'Unknown') & (~updated_bgg_data['id'].isin(prev_bgg_enriched_data['id']))]
-    logger.info(f"Fetching details for {len(games_to_enrich)} games...")
+    games_to_enrich = updated_bgg_data.loc[updated_bgg_data['id'].notna() & (~updated_bgg_data['id'].isin(prev_bgg_enriched_data['id']))].drop_duplicates(subset=['id'])
 
-    # call the BGG API for the details
-    bgg_enriched = call_bgg_for_details(games_to_enrich)
-    bgg_enriched = pd.concat([bgg_enriched, prev_bgg_enriched_data]).drop_duplicates(subset=['id'], keep='last')
-    
+    # Refresh the statistics of the stalest enriched games within the request
+    # budget, wishlisted, available and recently changed games first. The flags
+    # of an older state file are moved to the annotation store before they are read
+    refresh_budget = REFRESH_BUDGET if context.refresh_budget is None else context.refresh_budget
+    ensure_store()
+    refresh_ids = select_refresh(join_annotations(prev_final_data), refresh_budget, bgg_cache)
+    metrics.count('details_to_refresh', len(refresh_ids))
+    games_to_refresh = pd.DataFrame({'id': pd.array(refresh_ids, dtype='Int64')})
+    logger.info(f"Fetching details for {len(games_to_enrich)} games and refreshing {len(games_to_refresh)} games...")
+    progress.stage('details', details_total=len(games_to_enrich) + len(games_to_refresh))
+    metrics.count('details_to_fetch', len(games_to_enrich) + len(games_to_refresh))
 
-    # If columns 'played' and 'wishlist' are not present, add them
-    if 'played' not in prev_final_data.columns and 'wishlist' not in prev_final_data.columns:
-        prev_final_data['played'] = False
-        prev_final_data['wishlist'] = False
+    # call the BGG API for the details, refreshed details replace the previous ones.
+    # The refresh has its own batches, so the budget caps the requests it sends
+    with metrics.stage('details'):
+        bgg_enriched = coerce_types(pd.concat([
+            call_bgg_for_details(games_to_enrich, checkpoint, bgg_cache),
+            call_bgg_for_details(games_to_refresh, checkpoint, bgg_cache, max_requests=refresh_budget)],
+            ignore_index=True))
+        # A detail answered from the cache is as old as its cached response
+        fetched_at = bgg_cache.thing_fetched_at(bgg_enriched['id'].dropna())
+        now = time.time()
+        bgg_enriched['bgg_fetched_at'] = pd.to_datetime([
+            pd.Timestamp.fromtimestamp(fetched_at.get(str(game_id), now)) if pd.notna(game_id) else None
+            for game_id in bgg_enriched['id']]).astype('datetime64[ns]')
+        bgg_enriched = pd.concat([bgg_enriched, prev_bgg_enriched_data]).drop_duplicates(subset=['id'], keep='first')
+    
 
-    # Merge the two DataFrames info the final data
-    prev_final_data = prev_final_data[['name', 'state_previous', 'state_current', 'state_since', 'status', 'played', 'wishlist']] # only keep the necessary columns to prevent duplicates
-    final_data = prev_final_data.merge(updated_bgg_data, how='left', on='name')
-    final_data = final_data.merge(bgg_enriched, how='left', on='id')
+    # Merge the new run with the BGG data. The played and wishlist flags live in
+    # the annotation store and are joined on read, so the scrape never writes them
+    with metrics.stage('merge'):
+        final_data = output.merge(updated_bgg_data, how='left', on='name')
+        final_data = final_data.merge(bgg_enriched, how='left', on='id')
     
-    # Re-order columns
-    final_data = final_data[['name', 'state_previous', 'state_current', 'state_since', 'status', 'id', 'title', 'year', 'best_with', 'recommended_with', 'avg_rating', 'no_ratings', 'bgg_rank', 'played', 'wishlist']]
-    # if the state_current is nan, the game has been removed
+        # Re-order columns
+        final_data = final_data[['source', 'name', 'state_previous', 'state_current', 'state_since', 'status', 'id', 'match_confidence', 'title', 'year', 'best_with', 'recommended_with', 'avg_rating', 'no_ratings', 'bgg_rank', 'bgg_fetched_at']]
+        # if the state_current is nan, the game has been removed
   
     # Save the output files
     logger.info("Saving output files...")
-    final_data.to_csv(final_data_path, index=False)
+    progress.stage('save')
+    with metrics.stage('save'):
+        if states_equal(final_data, prev_final_data):
+            logger.info("No changes, the state is not written.")
+        else:
+            context.saved_state(save_state(final_data, csv_export=context.csv_export, previous=prev_final_data))
+        # Record the transitions of this run once the state is saved
+        # The first append also stores every game, so runs are appended until then
+        if output['status'].isin(EVENT_STATUSES).any() or not log_seeded():
+            append_events(output)
+        checkpoint.clear()
+        # Let the next update skip everything after the scrape if nothing changes
+        unmatched = final_data.loc[final_data['id'].isna(), 'name'].drop_duplicates()
+        unenriched = final_data.loc[final_data['id'].notna() & final_data['title'].isna(), 'id'].drop_duplicates()
+        write_digest(availability, settled=bool((final_data['status'] == 'No Change').all()),
+                     next_lookup_at=bgg_cache.next_expiry([clean_name(name) for name in unmatched], unenriched),
+                     next_refresh_at=next_refresh_at(final_data, bgg_cache))
     logger.info("Complete.")
     print("Complete.")
 
+
+# Set while run_locked runs an update, so a cancel between the updates of the daemon does nothing
+updating = threading.Event()
+
+
+def stop(signum, frame):
+    # Stop the process like Ctrl-C, the checkpoint keeps the results fetched so far
+    raise KeyboardInterrupt
+
+
+def cancel(signum, frame):
+    # Stop only the running update, the daemon carries on with the next cycle
+    if updating.is_set():
+        raise UpdateCancelled()
+
+
+def run_locked(context=None, force=False, sources=None):
+    '''
+    Run an update while holding the update lock, reporting its progress and
+    writing its run report. Raises UpdateRunning if another update holds the lock.
+    '''
+    with UpdateLock():
+        progress.start()
+        metrics.reset()
+        status = 'failed'
+        updating.set()
+        try:
+            run_update(context, force, sources)
+            status = 'finished'
+        except (KeyboardInterrupt, UpdateCancelled):
+            status = 'cancelled'
+            logger.warning("Update cancelled.")
+            progress.finish('cancelled')
+            raise
+        except Exception as e:
+            logger.exception("Update failed.")
+            progress.finish('failed', str(e))
+            raise
+        finally:
+            updating.clear()
+            # The run report is written for failed and cancelled runs too
+            run_report = metrics.write_report(status)
+            logger.info("Stage times: " + ', '.join(f"{name} {values['wall_seconds']:.1f}s"
+                                                    for name, values in run_report['stages'].items()))
+        progress.finish('finished')
+
+
+def run_cycle(context, sources=None):
+    '''
+    Run one update of the daemon, skipping it if another update is running. A
+    cancelled update ends the cycle, only KeyboardInterrupt stops the daemon.
+    '''
+    try:
+        run_locked(context, sources=sources)
+    except UpdateRunning:
+        logger.warning("Another update is running, skipping this cycle.")
+    except UpdateCancelled:
+        logger.warning("Update cancelled, skipping the rest of this cycle.")
+
+
+def main(argv=None):
+    '''
+    Command line entry point. Runs one update, or keeps updating with --daemon,
+    and returns the exit code.
+    '''
+    parser = argparse.ArgumentParser(description='Scrape the library and enrich it with BGG data.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and update every --interval minutes, with warm state between updates')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='minutes between updates')
+    parser.add_argument('--jitter', type=float, default=DEFAULT_JITTER,
+                        help='up to this many seconds are added to every wait')
+    parser.add_argument('--quiet-hours', type=parse_quiet_hours, help="no updates during these hours, e.g. '23-7'")
+    parser.add_argument('--force', action='store_true',
+                        help='run the whole update and save the output even if nothing changed')
+    parser.add_argument('--source', action='append', dest='sources', metavar='KEY',
+                        help='only scrape this source, can be given more than once (default: all sources)')
+    parser.add_argument('--refresh-budget', type=int, metavar='REQUESTS',
+                        help='BGG requests per update spent on refreshing the statistics of stale games, '
+                             '0 turns the refresh off (default: 5)')
+    args = parser.parse_args(argv)
+    sources = None
+    if args.sources:
+        from sources import get_source
+        try:
+            sources = [get_source(key) for key in args.sources]
+        except KeyError as e:
+            parser.error(e.args[0])
+
+    signal.signal(signal.SIGTERM, stop)
+    if CANCEL_SIGNAL != signal.SIGTERM:
+        signal.signal(CANCEL_SIGNAL, cancel)
+    if args.daemon:
+        # The daemon only writes the state when it changes and skips the CSV export
+        context = UpdateContext(csv_export=False, refresh_budget=args.refresh_budget)
+        logger.info(f"Starting daemon with an interval of {args.interval} minutes")
+        try:
+            run_daemon(lambda: run_cycle(context, sources), args.interval, args.jitter, args.quiet_hours)
+        except KeyboardInterrupt:
+            logger.info("Daemon stopped.")
+        return 0
+
+    try:
+        run_locked(UpdateContext(refresh_budget=args.refresh_budget), force=args.force, sources=sources)
+    except (KeyboardInterrupt, UpdateCancelled):
+        return 130
+    except UpdateRunning:
+        logger.warning("Another update is already running. Exiting.")
+        print("Another update is already running.")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
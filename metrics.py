@@ -0,0 +1,196 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from output_files import OUTPUT_DIR, write_atomic
+
+REPORT_PATH = os.path.join(OUTPUT_DIR, 'run_report.json')
+# Picked up by the textfile collector of the Prometheus node exporter
+PROMETHEUS_PATH = os.path.join(OUTPUT_DIR, 'dragon_scrape.prom')
+PREFIX = 'dragon_scrape'
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_run = {}
+
+
+def reset():
+    '''
+    Start collecting the metrics of a new run.
+    '''
+    global _run
+    with _lock:
+        _run = {
+            'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'started': time.time(),
+            'stages': {},
+            'endpoints': {},
+            'sleeps': {},
+            'counts': {}
+        }
+
+
+reset()
+
+
+@contextmanager
+def stage(name):
+    '''
+    Record the wall time and CPU time of a pipeline stage. The CPU time is of the
+    whole process, so it includes the worker threads of the stage.
+    '''
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        with _lock:
+            stages = _run['stages']
+            totals = stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            totals['wall_seconds'] += time.perf_counter() - wall
+            totals['cpu_seconds'] += time.process_time() - cpu
+
+
+def observe_request(endpoint, status, seconds, size):
+    '''
+    Record an HTTP request to an endpoint: its status code ('error' if there was
+    no response), latency and the bytes received.
+    '''
+    with _lock:
+        endpoint_metrics = _run['endpoints'].setdefault(endpoint, {
+            'requests': {}, 'bytes': 0, 'latency_sum': 0.0, 'latency_max': 0.0,
+            'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)
+        })
+        statuses = endpoint_metrics['requests']
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        endpoint_metrics['bytes'] += size
+        endpoint_metrics['latency_sum'] += seconds
+        endpoint_metrics['latency_max'] = max(endpoint_metrics['latency_max'], seconds)
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        endpoint_metrics['latency_buckets'][bucket] += 1
+
+
+def observe_sleep(target, reason, seconds):
+    '''
+    Record time spent waiting instead of sending requests, for example a retry
+    backoff or a rate limit pause. target is the endpoint of the request that waited.
+    '''
+    if seconds <= 0:
+        return
+    with _lock:
+        key = f'{target}|{reason}'
+        _run['sleeps'][key] = _run['sleeps'].get(key, 0.0) + seconds
+
+
+def count(name, value):
+    '''
+    Set a count of the run, such as the number of new games.
+    '''
+    with _lock:
+        _run['counts'][name] = value
+
+
+def report(status):
+    '''
+    Return the metrics of the run as a dict, with status 'finished', 'failed'
+    or 'cancelled'.
+    '''
+    with _lock:
+        endpoints = {}
+        for endpoint, values in _run['endpoints'].items():
+            requests = sum(values['requests'].values())
+            endpoints[endpoint] = {
+                'requests': dict(values['requests']),
+                'bytes': values['bytes'],
+                'latency_mean_seconds': round(values['latency_sum'] / requests, 4) if requests else None,
+                'latency_max_seconds': round(values['latency_max'], 4),
+                'latency_buckets': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], values['latency_buckets'])),
+                'latency_sum_seconds': round(values['latency_sum'], 4)
+            }
+        sleeps = {}
+        for key, seconds in _run['sleeps'].items():
+            target, reason = key.split('|')
+            sleeps.setdefault(target, {})[reason] = round(seconds, 3)
+        return {
+            'status': status,
+            'started_at': _run['started_at'],
+            'duration_seconds': round(time.time() - _run['started'], 3),
+            'stages': {name: {key: round(value, 3) for key, value in totals.items()}
+                       for name, totals in _run['stages'].items()},
+            'http': endpoints,
+            'sleep_seconds': sleeps,
+            'counts': dict(_run['counts'])
+        }
+
+
+def sample(name, labels, value):
+    label_text = ','.join(f'{key}="{label_value}"' for key, label_value in labels.items())
+    return f'{PREFIX}_{name}{{{label_text}}} {value}' if labels else f'{PREFIX}_{name} {value}'
+
+
+def prometheus_text(run_report):
+    '''
+    Format a run report in the Prometheus text exposition format.
+    '''
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+        lines.extend(sample(name, labels, value) for labels, value in samples)
+
+    started = datetime.strptime(run_report['started_at'], '%Y-%m-%d %H:%M:%S')
+    metric('last_run_timestamp_seconds', 'gauge', 'Start time of the last run.', [({}, int(started.timestamp()))])
+    metric('last_run_success', 'gauge', 'Whether the last run finished.',
+           [({}, int(run_report['status'] == 'finished'))])
+    metric('last_run_duration_seconds', 'gauge', 'Wall time of the last run.', [({}, run_report['duration_seconds'])])
+    metric('stage_wall_seconds', 'gauge', 'Wall time of each pipeline stage in the last run.',
+           [({'stage': name}, values['wall_seconds']) for name, values in run_report['stages'].items()])
+    metric('stage_cpu_seconds', 'gauge', 'Process CPU time of each pipeline stage in the last run.',
+           [({'stage': name}, values['cpu_seconds']) for name, values in run_report['stages'].items()])
+    metric('http_requests', 'gauge', 'HTTP requests per endpoint and status in the last run.',
+           [({'endpoint': endpoint, 'status': status}, number)
+            for endpoint, values in run_report['http'].items() for status, number in values['requests'].items()])
+    metric('http_response_bytes', 'gauge', 'Bytes received per endpoint in the last run.',
+           [({'endpoint': endpoint}, values['bytes']) for endpoint, values in run_report['http'].items()])
+
+    # The histogram has cumulative buckets and a _sum and _count per endpoint
+    name = 'http_request_duration_seconds'
+    lines.append(f'# HELP {PREFIX}_{name} Latency of the HTTP requests in the last run.')
+    lines.append(f'# TYPE {PREFIX}_{name} histogram')
+    for endpoint, values in run_report['http'].items():
+        cumulative = 0
+        for bound, number in values['latency_buckets'].items():
+            cumulative += number
+            lines.append(sample(f'{name}_bucket', {'endpoint': endpoint, 'le': bound}, cumulative))
+        lines.append(sample(f'{name}_sum', {'endpoint': endpoint}, values['latency_sum_seconds']))
+        lines.append(sample(f'{name}_count', {'endpoint': endpoint}, cumulative))
+
+    metric('sleep_seconds', 'gauge', 'Time spent waiting on retries and rate limits in the last run.',
+           [({'target': target, 'reason': reason}, seconds)
+            for target, reasons in run_report['sleep_seconds'].items() for reason, seconds in reasons.items()])
+    metric('run_count', 'gauge', 'Counts of the last run, such as new games.',
+           [({'name': name}, value) for name, value in run_report['counts'].items()])
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(status, report_path=REPORT_PATH, prometheus_path=PROMETHEUS_PATH):
+    '''
+    Write the run report as JSON and as a Prometheus textfile. Returns the report.
+    '''
+    run_report = report(status)
+
+    def write_json(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(run_report, file, indent=2)
+
+    def write_prometheus(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(prometheus_text(run_report))
+
+    write_atomic(report_path, write_json)
+    write_atomic(prometheus_path, write_prometheus)
+    return run_report
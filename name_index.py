@@ -0,0 +1,170 @@
+import logging
+import re
+import unicodedata
+import xml.etree.ElementTree as etree
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Words that only describe the edition and don't help to tell games apart
+EDITION_WORDS = {'svensk', 'svenska', 'utgava', 'nordisk', 'nordic', 'engelsk', 'english',
+                 'edition', 'version', 'swe', 'eng'}
+# Weight of the trigram similarity in the score, the rest is token similarity
+TRIGRAM_WEIGHT = 0.6
+# Names matched with at least this confidence are resolved without the API
+RESOLVE_THRESHOLD = 0.9
+# Matches below this confidence are flagged for review
+REVIEW_THRESHOLD = 0.6
+# A candidate with another ID scoring within this margin of the best one lowers
+# the confidence, as the name can't tell the two games apart
+AMBIGUITY_MARGIN = 0.15
+
+
+def normalize_name(name):
+    '''
+    Normalize a game name for matching: lower case without accents, without
+    '-Säljs från Lånebiblioteket-' style prefixes, text in brackets, punctuation
+    and edition words.
+    '''
+    name = unicodedata.normalize('NFKD', str(name).lower())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r'^\s*-[^-]+-', ' ', name)
+    name = re.sub(r'\(.*?\)|\[.*?\]', ' ', name)
+    name = re.sub(r'[\W_]+', ' ', name)
+    return ' '.join(token for token in name.split() if token not in EDITION_WORDS)
+
+
+def trigrams(normalized):
+    padded = f'  {normalized} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def tokens(normalized):
+    return set(normalized.split())
+
+
+class Postings:
+    '''
+    Inverted index from features (trigrams or tokens) to the entries that have
+    them, stored as one sorted array of entry numbers with offsets per feature.
+    '''
+
+    def __init__(self, feature_sets):
+        self.vocabulary = {}
+        features, entries = [], []
+        for entry, feature_set in enumerate(feature_sets):
+            for feature in feature_set:
+                features.append(self.vocabulary.setdefault(feature, len(self.vocabulary)))
+                entries.append(entry)
+        features = np.asarray(features, dtype=np.int64)
+        order = np.argsort(features, kind='stable')
+        self.entries = np.asarray(entries, dtype=np.int64)[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(features, minlength=len(self.vocabulary)))))
+        self.sizes = np.array([len(feature_set) for feature_set in feature_sets], dtype=np.float64)
+
+    def dice(self, feature_set):
+        '''
+        Return the Dice similarity of the feature set to every entry.
+        '''
+        ids = [self.vocabulary[feature] for feature in feature_set if feature in self.vocabulary]
+        if not ids:
+            return np.zeros(len(self.sizes))
+        matches = np.concatenate([self.entries[self.offsets[i]:self.offsets[i + 1]] for i in ids])
+        shared = np.bincount(matches, minlength=len(self.sizes))
+        return 2 * shared / (len(feature_set) + self.sizes)
+
+
+class NameIndex:
+    '''
+    Local index of the BGG titles and alternate names seen so far, used to
+    resolve names without calling the search API.
+
+    Candidates are scored with the Dice similarity of their trigrams and tokens.
+    The postings are built on the first match after names were added, so all
+    names should be added before matching starts.
+    '''
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.normalized = []
+        self.seen = set()
+        self.trigram_postings = None
+        self.token_postings = None
+        self.id_array = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, bgg_id, name):
+        normalized = normalize_name(name)
+        if not normalized or (normalized, str(bgg_id)) in self.seen:
+            return
+        self.seen.add((normalized, str(bgg_id)))
+        self.ids.append(str(bgg_id))
+        self.names.append(name)
+        self.normalized.append(normalized)
+        self.trigram_postings = None
+
+    def add_items(self, content):
+        '''
+        Add the names of every <item> of a search or thing response.
+        '''
+        for item in etree.fromstring(content).iter('item'):
+            for name in item.findall('name'):
+                if name.get('value'):
+                    self.add(item.get('id'), name.get('value'))
+
+    @classmethod
+    def from_responses(cls, responses):
+        index = cls()
+        for content in responses:
+            try:
+                index.add_items(content)
+            except etree.ParseError:
+                continue
+        return index
+
+    @classmethod
+    def from_cache(cls, cache):
+        '''
+        Build the index from all search and thing responses in a BggCache,
+        including expired ones, as the names of a game don't change.
+        '''
+        index = cls.from_responses(cache.iter_responses())
+        logger.info(f"Built name index with {len(index)} names")
+        return index
+
+    def build(self):
+        self.id_array = np.asarray(self.ids)
+        self.trigram_postings = Postings([trigrams(name) for name in self.normalized])
+        self.token_postings = Postings([tokens(name) for name in self.normalized])
+
+    def scores(self, normalized):
+        '''
+        Return the similarity of a normalized name to every entry, between 0 and 1.
+        '''
+        if self.trigram_postings is None:
+            self.build()
+        return (TRIGRAM_WEIGHT * self.trigram_postings.dice(trigrams(normalized))
+                + (1 - TRIGRAM_WEIGHT) * self.token_postings.dice(tokens(normalized)))
+
+    def match(self, name):
+        '''
+        Return the best match for a name as (BGG ID, confidence, matched name),
+        or None if no name in the index shares anything with it. The confidence
+        is the score of the best match, lowered when another game scores close to it.
+        '''
+        normalized = normalize_name(name)
+        if not self.ids or not normalized:
+            return None
+        scores = self.scores(normalized)
+        # Entries are in the order they were added, so ties go to the first one
+        best = int(np.argmax(scores))
+        if scores[best] == 0:
+            return None
+        other_games = scores[self.id_array != self.ids[best]]
+        runner_up = other_games.max() if len(other_games) else 0.0
+        confidence = scores[best] - max(0.0, AMBIGUITY_MARGIN - (scores[best] - runner_up))
+        return self.ids[best], round(float(max(confidence, 0.0)), 3), self.names[best]
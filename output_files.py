@@ -0,0 +1,59 @@
+import importlib.util
+import os
+import tempfile
+
+# Paths and helpers of the output directory. This module only uses the standard
+# library, so the command line and the no-change path of an update don't have
+# to import pandas to find or version the output files.
+
+# The output lives next to this file, so the Streamlit app can use it from its own directory
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
+STATE_PATH = os.path.join(OUTPUT_DIR, 'final_data.parquet')
+CSV_PATH = os.path.join(OUTPUT_DIR, 'final_data.csv')
+# Rows changed since the state file was last written in full, see state_store.save_state
+DELTA_PATH = os.path.join(OUTPUT_DIR, 'final_data.delta.parquet')
+
+# Checked without importing pyarrow, pandas imports it when it reads or writes Parquet
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+
+def write_atomic(path, write):
+    '''
+    Write a file through a temporary file in the same directory that is renamed
+    over the target, so a crash never leaves a truncated file behind.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def file_version(*paths):
+    '''
+    Return the path, modification time and size of the first existing file.
+    Used as cache key, so the cached data is reloaded when the file changes.
+    '''
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        return path, stat.st_mtime_ns, stat.st_size
+    return None
+
+
+def state_version():
+    '''
+    Return the version of the files the state is loaded from, or None if there
+    is no state yet.
+    '''
+    if not PARQUET_AVAILABLE:
+        return file_version(CSV_PATH)
+    version = file_version(STATE_PATH, CSV_PATH)
+    delta_version = file_version(DELTA_PATH)
+    return version + delta_version if version and delta_version else version
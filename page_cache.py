@@ -0,0 +1,89 @@
+import json
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join('output', 'page_cache')
+
+# Entries read or written by this process, so a long-running process reads
+# every cache file only once
+_entries = {}
+
+
+def content_hash(page_content):
+    '''
+    Hash the HTML content of a page to detect unchanged pages.
+    '''
+    return hashlib.sha256(page_content.encode('utf-8')).hexdigest()
+
+
+def cache_path(page_number, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f'page_{page_number}.json')
+
+
+def load_entry(page_number, cache_dir=CACHE_DIR):
+    '''
+    Load the cached response of a page. Returns None if the page is not cached
+    or the cache file can't be read.
+    '''
+    path = cache_path(page_number, cache_dir)
+    if path in _entries:
+        return _entries[path]
+    try:
+        with open(path, encoding='utf-8') as file:
+            entry = _entries[path] = json.load(file)
+            return entry
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable cache entry for page {page_number}: {e}")
+        return None
+
+
+def save_entry(page_number, entry, cache_dir=CACHE_DIR):
+    '''
+    Save the cached response of a page. The file is written to a temporary file
+    first and then renamed, so a crash never leaves a half-written entry.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(tmp_path, cache_path(page_number, cache_dir))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    _entries[cache_path(page_number, cache_dir)] = entry
+
+
+def make_entry(response, page_hash, games, page_count, parser=None):
+    '''
+    Create a cache entry from a response and the games parsed from it. parser
+    identifies the parser and config that produced the games, an entry is only
+    used by the same parser.
+    '''
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': page_hash,
+        'parser': parser,
+        'page_count': page_count,
+        'games': games
+    }
+
+
+def conditional_headers(entry):
+    '''
+    Build the headers for a conditional request from a cache entry.
+    '''
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from output_files import OUTPUT_DIR, write_atomic
+
+PROGRESS_PATH = os.path.join(OUTPUT_DIR, 'progress.json')
+# Seconds between writes of the progress file while a stage is running
+WRITE_INTERVAL = 0.5
+
+_progress = None
+_written_at = 0.0
+_lock = threading.Lock()
+
+
+def _write(force=False):
+    global _written_at
+    now = time.monotonic()
+    if not force and now - _written_at < WRITE_INTERVAL:
+        return
+    _written_at = now
+    _progress['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    content = json.dumps(_progress)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+    write_atomic(PROGRESS_PATH, write)
+
+
+def start():
+    '''
+    Start reporting the progress of this process to the progress file. Until
+    start is called, the other functions do nothing.
+    '''
+    global _progress
+    with _lock:
+        _progress = {
+            'pid': os.getpid(),
+            'status': 'running',
+            'stage': 'starting',
+            'counts': {},
+            'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'error': None
+        }
+        _write(force=True)
+
+
+def stage(name, **counts):
+    '''
+    Report the start of a stage, optionally with initial counts such as totals.
+    '''
+    with _lock:
+        if _progress is None:
+            return
+        _progress['stage'] = name
+        _progress['counts'].update(counts)
+        _write(force=True)
+
+
+def increment(counter, amount=1):
+    '''
+    Increase a counter of the running stage, for example the pages fetched.
+    '''
+    with _lock:
+        if _progress is None:
+            return
+        _progress['counts'][counter] = _progress['counts'].get(counter, 0) + amount
+        _write()
+
+
+def finish(status, error=None):
+    '''
+    Report the end of the run: 'finished', 'failed' or 'cancelled'.
+    '''
+    with _lock:
+        if _progress is None:
+            return
+        _progress['status'] = status
+        _progress['error'] = error
+        _write(force=True)
+
+
+def read():
+    '''
+    Read the progress of the last run, or None if there is none.
+    '''
+    try:
+        with open(PROGRESS_PATH, encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value, default):
+    '''
+    Parse a Retry-After header, given either in seconds or as an HTTP date.
+    Returns default if the header is missing or invalid.
+    '''
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RateGovernor:
+    '''
+    Limits the requests to an API that are shared between threads.
+
+    Requests are spread out by a token bucket of `rate` requests per second with
+    room for `burst` requests at once. The number of requests in flight is
+    adapted with AIMD: it grows by one every `limit` successful requests and is
+    halved on a 429, after which all requests wait for the Retry-After period.
+    '''
+
+    def __init__(self, rate=1.0, burst=2, concurrency=2, max_concurrency=4, default_retry_after=10, name='api'):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.default_retry_after = default_retry_after
+        self.active = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+        # Counters for logging and metrics
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, endpoint=None):
+        '''
+        Block until a request may be sent. The wait is recorded against the
+        endpoint of the request, or the name of the governor without one.
+        '''
+        started = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if self.active >= int(self.limit):
+                    self.condition.wait()
+                elif now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    self.requests += 1
+                    self.wait_time += now - started
+                    metrics.observe_sleep(endpoint or self.name, 'rate_limit', now - started)
+                    return
+
+    def release(self, status_code=None, retry_after=None):
+        '''
+        Free the slot of a request and adapt to its outcome. status_code is None
+        if the request failed without a response.
+        '''
+        with self.condition:
+            self.active -= 1
+            if status_code == 429:
+                delay = parse_retry_after(retry_after, self.default_retry_after)
+                self.limit = max(1.0, self.limit / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                self.tokens = 0.0
+                self.throttled += 1
+                logger.warning(f"Rate limited. Pausing for {delay:.0f} seconds, concurrency limit {int(self.limit)}")
+            elif status_code is not None and status_code < 500:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def call(self, send, endpoint=None):
+        '''
+        Send a request through the governor. send is called without arguments
+        once a request may be sent and must return the response. endpoint is
+        what the time waited is recorded against (see acquire).
+        '''
+        self.acquire(endpoint)
+        response = None
+        try:
+            response = send()
+            return response
+        finally:
+            if response is None:
+                self.release()
+            else:
+                self.release(response.status_code, response.headers.get('Retry-After'))
@@ -0,0 +1,178 @@
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Player counts of the player-count features, higher counts are folded into the last one
+MAX_PLAYERS = 10
+# Columns served by the filter index, next to the number of players
+FILTER_COLUMNS = ['source', 'state_current', 'status', 'played', 'wishlist', 'year']
+# Weights of the feature groups in the scores
+RATING_WEIGHT = 1.0
+POPULARITY_WEIGHT = 0.5
+PLAYERS_WEIGHT = 1.0
+AVAILABLE_WEIGHT = 0.5
+# Played games count this much in the profile, wishlisted games count 1
+PLAYED_WEIGHT = 0.5
+# Number of recommendations returned by default
+RECOMMENDATIONS = 20
+
+PLAYER_COUNT_PATTERN = re.compile(r'(\d+)\s*(?:[–-]\s*(\d+)|(\+))?')
+
+
+def player_counts(text):
+    '''
+    Return the player counts of a BGG poll summary, e.g. 'Best with 3–4 players'
+    gives {3, 4}. 'n+' means n players and more, counts above MAX_PLAYERS count
+    as MAX_PLAYERS.
+    '''
+    counts = set()
+    if not isinstance(text, str):
+        return counts
+    for low, high, plus in PLAYER_COUNT_PATTERN.findall(text):
+        high = MAX_PLAYERS if plus else int(high or low)
+        counts.update(range(min(int(low), MAX_PLAYERS), min(high, MAX_PLAYERS) + 1))
+    counts.discard(0)
+    return counts
+
+
+def player_matrix(summaries):
+    '''
+    Return a boolean matrix with a row per poll summary and a column per player
+    count from 1 to MAX_PLAYERS. Every distinct summary is parsed once.
+    '''
+    codes, uniques = pd.factorize(pd.Series(summaries, dtype=object))
+    # The extra last row stays False, it is the row of the missing summaries (code -1)
+    table = np.zeros((len(uniques) + 1, MAX_PLAYERS), dtype=bool)
+    for row, text in enumerate(uniques):
+        for count in player_counts(text):
+            table[row, count - 1] = True
+    return table[codes]
+
+
+def standardize(values):
+    '''
+    Return the z-scores of the values. Missing values get 0, the mean, so they
+    don't pull a game either way.
+    '''
+    known = ~np.isnan(values)
+    if not known.any():
+        return np.zeros_like(values)
+    mean, std = values[known].mean(), values[known].std()
+    return np.where(known, (values - mean) / (std or 1.0), 0.0)
+
+
+class FilterIndex:
+    '''
+    Precomputed masks of the games with each value of the filter columns, and
+    of the games recommended (or best) with each number of players ('players').
+
+    A filter selects values per column. A game matches a column if it has one
+    of the selected values, and the filter if it matches every column, so a
+    filter is a few ORs and ANDs of the masks instead of a scan of the games.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.values = {}
+        self.positions = {}
+        self.masks = {}
+
+    def add(self, column, values, masks):
+        self.values[column] = values
+        self.positions[column] = {value: position for position, value in enumerate(values)}
+        self.masks[column] = masks
+
+    @classmethod
+    def from_games(cls, df, columns=FILTER_COLUMNS):
+        index = cls(len(df))
+        for column in columns:
+            codes, uniques = pd.factorize(df[column], sort=True)
+            index.add(column, list(uniques), codes[np.newaxis, :] == np.arange(len(uniques))[:, np.newaxis])
+        players = player_matrix(df['best_with']) | player_matrix(df['recommended_with'])
+        index.add('players', list(range(1, MAX_PLAYERS + 1)), players.T.copy())
+        return index
+
+    def mask(self, selections):
+        '''
+        Return the boolean mask of the games matching the selections, a dict of
+        column -> selected values. Columns without selected values match every game.
+        '''
+        mask = np.ones(self.size, dtype=bool)
+        for column, selected in selections.items():
+            if not selected:
+                continue
+            positions = [self.positions[column][value] for value in selected if value in self.positions[column]]
+            mask &= self.masks[column][positions].any(axis=0)
+        return mask
+
+
+class RecommendationIndex:
+    '''
+    Feature matrix of the games, with a row per game and the columns: rating,
+    popularity (log of the number of ratings), player-count fit (1 for the
+    counts a game is best with, 0.5 for the recommended ones) and availability.
+
+    A profile is the weighted mean of the rows of the wishlisted and played
+    games, and the score of every game is the product of the matrix with the
+    profile. The player-count and availability parts of the query come from
+    the player counts asked for and whether available games are preferred.
+    '''
+
+    def __init__(self, features, names):
+        self.features = features
+        # Games listed by several sources are only recommended once
+        self.name_codes = pd.factorize(names)[0]
+        self.players = slice(2, 2 + MAX_PLAYERS)
+        self.available = 2 + MAX_PLAYERS
+
+    def __len__(self):
+        return len(self.features)
+
+    @classmethod
+    def from_games(cls, df):
+        rating = standardize(df['avg_rating'].to_numpy(dtype=np.float64, na_value=np.nan))
+        popularity = standardize(np.log1p(df['no_ratings'].to_numpy(dtype=np.float64, na_value=np.nan)))
+        players = np.where(player_matrix(df['best_with']), 1.0,
+                           np.where(player_matrix(df['recommended_with']), 0.5, 0.0))
+        available = (df['state_current'] == 'Available').fillna(False).to_numpy(dtype=np.float64)
+        features = np.column_stack([RATING_WEIGHT * rating, POPULARITY_WEIGHT * popularity,
+                                    PLAYERS_WEIGHT * players, AVAILABLE_WEIGHT * available])
+        logger.info(f"Built recommendation index with {len(features)} games")
+        return cls(features, df['name'])
+
+    def query(self, played, wishlist, players=(), prefer_available=True):
+        '''
+        Return the query vector of a profile. Without played or wishlisted games
+        the profile prefers well rated, popular games.
+        '''
+        weights = wishlist.astype(np.float64) + PLAYED_WEIGHT * played
+        if weights.sum() > 0:
+            query = weights @ self.features / weights.sum()
+        else:
+            query = np.zeros(self.features.shape[1])
+            query[0], query[1] = RATING_WEIGHT, POPULARITY_WEIGHT
+        query[self.available] = AVAILABLE_WEIGHT if prefer_available else 0.0
+        for count in players:
+            query[self.players.start + count - 1] += PLAYERS_WEIGHT
+        return query
+
+    def rank(self, played, wishlist, players=(), prefer_available=True, mask=None, limit=RECOMMENDATIONS):
+        '''
+        Return the positions and scores of the best games for the profile of the
+        played and wishlisted games (boolean arrays), best first. Played and
+        wishlisted games are not recommended, and with a mask only its games are.
+        '''
+        scores = self.features @ self.query(played, wishlist, players, prefer_available)
+        allowed = ~(played | wishlist)
+        if mask is not None:
+            allowed &= mask
+        positions = np.flatnonzero(allowed)
+        positions = positions[np.argsort(-scores[positions], kind='stable')]
+        # Keep the best listing of every game, in the order of the scores
+        _, first = np.unique(self.name_codes[positions], return_index=True)
+        positions = positions[np.sort(first)][:limit]
+        return positions, scores[positions]
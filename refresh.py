@@ -0,0 +1,103 @@
+import logging
+import time
+
+import pandas as pd
+
+from bgg_api import DETAILS_BATCH_SIZE
+from bgg_cache import DAY
+
+logger = logging.getLogger(__name__)
+
+# Requests per update spent on refreshing the statistics of enriched games. A
+# request is a batch of up to DETAILS_BATCH_SIZE games or a retry of a single
+# game missing from a batch, 0 turns the refresh off
+REFRESH_BUDGET = 5
+# The statistics of a game are refreshed once they are this old (in seconds)
+REFRESH_AGE = 14 * DAY
+# Games that changed within this many days count as recently changed
+RECENT_DAYS = 7
+# The staleness of a game is multiplied by 1 plus these weights, so games users
+# care about are refreshed first among games of the same age
+WISHLIST_WEIGHT = 2.0
+AVAILABLE_WEIGHT = 1.0
+CHANGED_WEIGHT = 1.0
+
+
+def age_seconds(state, now=None):
+    '''
+    Return how old the BGG data of every game is, in seconds. bgg_fetched_at is
+    local time, like state_since. Games fetched before it was tracked count as
+    fetched at the epoch.
+    '''
+    fetched_at = pd.to_datetime(state['bgg_fetched_at']).fillna(pd.Timestamp.fromtimestamp(0))
+    return (pd.Timestamp.fromtimestamp(now or time.time()) - fetched_at).dt.total_seconds()
+
+
+def listed_enriched(state):
+    # Removed games keep their statistics as they were
+    return state.loc[state['id'].notna() & state['title'].notna() & state['state_current'].notna()]
+
+
+def refresh_candidates(state, cache=None, now=None):
+    '''
+    Return the rows of the listed, enriched games whose statistics are older
+    than REFRESH_AGE. Games with a fresh miss in the cache are skipped, as
+    refreshing them would not return anything.
+    '''
+    enriched = listed_enriched(state)
+    candidates = enriched.loc[age_seconds(enriched, now) >= REFRESH_AGE]
+    if cache is not None and len(candidates):
+        candidates = candidates.loc[~candidates['id'].astype(str).isin(cache.thing_misses())]
+    return candidates
+
+
+def refresh_priority(candidates, now=None):
+    '''
+    Return the refresh priority of every candidate: its staleness in days,
+    weighted up for wishlisted, available and recently changed games.
+    '''
+    age_days = age_seconds(candidates, now) / DAY
+    recent = pd.Timestamp.fromtimestamp(now or time.time()) - pd.Timedelta(days=RECENT_DAYS)
+    changed = candidates['status'].isin(['State Change', 'New Game']) | (candidates['state_since'] >= recent)
+    wishlist = candidates['wishlist'] if 'wishlist' in candidates.columns else False
+    weight = (1 + WISHLIST_WEIGHT * pd.Series(wishlist, index=candidates.index).fillna(False).astype(float)
+              + AVAILABLE_WEIGHT * (candidates['state_current'] == 'Available').fillna(False).astype(float)
+              + CHANGED_WEIGHT * changed.fillna(False).astype(float))
+    return age_days * weight
+
+
+def select_refresh(state, budget=REFRESH_BUDGET, cache=None, now=None):
+    '''
+    Return the IDs to refresh in this update: the highest priority candidates,
+    at most budget batches of DETAILS_BATCH_SIZE games. The IDs are fetched with
+    the budget as max_requests, so retries can leave the last ones for later.
+    The state should have the annotations joined, so wishlisted games are preferred.
+
+    A game listed by several sources gets the highest priority of its listings.
+    '''
+    if budget <= 0:
+        return []
+    candidates = refresh_candidates(state, cache, now)
+    if candidates.empty:
+        return []
+    priority = refresh_priority(candidates, now)
+    ids = (pd.DataFrame({'id': candidates['id'], 'priority': priority})
+           .sort_values('priority', ascending=False, kind='stable')
+           .drop_duplicates(subset=['id'])['id'])
+    selected = ids.head(budget * DETAILS_BATCH_SIZE).tolist()
+    logger.info(f"Refreshing the statistics of {len(selected)} of {len(ids)} stale games")
+    return selected
+
+
+def next_refresh_at(state, cache=None):
+    '''
+    Return when the statistics of the next game are due for a refresh, in
+    seconds since the epoch, or None if nothing will ever be due.
+    '''
+    enriched = listed_enriched(state)
+    if cache is not None and len(enriched):
+        enriched = enriched.loc[~enriched['id'].astype(str).isin(cache.thing_misses())]
+    if enriched.empty:
+        return None
+    oldest = pd.to_datetime(enriched['bgg_fetched_at']).fillna(pd.Timestamp.fromtimestamp(0)).min()
+    return oldest.to_pydatetime().timestamp() + REFRESH_AGE
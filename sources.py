@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Extra sources, as a JSON list of objects with the arguments of Source, e.g.
+# [{"key": "webshop-strategy", "url": "https://dragonslair.se/strategispel/", "title": "Strategy games"}]
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sources.json')
+# Source of the games in a state or event log written before there were several sources
+DEFAULT_SOURCE = 'lanebiblioteket'
+
+
+class Source:
+    '''
+    A listing to scrape, on a storefront with the markup of the Dragonslair
+    website. Every source has its own partition of the state, identified by key.
+
+    The parser config tells which div is a game card, which div in it holds
+    the stock text and which attribute of the card holds the product data. The
+    name-cleaning rules are the strings removed from the game names, and the
+    state rules the stock texts replaced with 'Available' (state_replacements)
+    and the stock texts that mean 'Unavailable'.
+    '''
+
+    def __init__(self, key, url, title=None, params=None, engine=None, card_class='column',
+                 stock_class='stock', product_attribute='data-product-object', name_removals=(),
+                 state_replacements=None, unavailable_states=('Beställningsvara', 'Slut i lager')):
+        self.key = key
+        self.url = url
+        self.title = title or key
+        # Query parameters sent with every page, next to the page number
+        self.params = params or {}
+        # Parser engine, see dragon_scrape.parse_games. None uses the default engine
+        self.engine = engine
+        self.card_class = card_class
+        self.stock_class = stock_class
+        self.product_attribute = product_attribute
+        self.name_removals = tuple(name_removals)
+        self.state_replacements = state_replacements or {'Finns i lager': 'Available'}
+        self.unavailable_states = tuple(unavailable_states)
+
+    def __repr__(self):
+        return f'Source({self.key!r}, {self.url!r})'
+
+    @classmethod
+    def from_dict(cls, config):
+        '''
+        Create a source from an entry of the sources file.
+        '''
+        try:
+            return cls(**config)
+        except TypeError as e:
+            raise ValueError(f"Invalid source {config!r}: {e}") from None
+
+
+_registry = {}
+_loaded = False
+
+
+def register(source):
+    '''
+    Add a source to the registry, replacing a source with the same key.
+    '''
+    _registry[source.key] = source
+    return source
+
+
+def load_sources(path=SOURCES_PATH):
+    '''
+    Register the sources of the sources file, if there is one.
+    '''
+    global _loaded
+    _loaded = True
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as file:
+        configs = json.load(file)
+    for config in configs:
+        register(Source.from_dict(config))
+    logger.info(f"Loaded {len(configs)} sources from {path}")
+
+
+def all_sources():
+    '''
+    Return the registered sources, loading the sources file the first time.
+    '''
+    if not _loaded:
+        load_sources()
+    return list(_registry.values())
+
+
+def get_source(key=DEFAULT_SOURCE):
+    '''
+    Return the source with the key. Raises KeyError for an unknown source.
+    '''
+    if key not in _registry and not _loaded:
+        load_sources()
+    try:
+        return _registry[key]
+    except KeyError:
+        raise KeyError(f"Unknown source '{key}'. Known sources: {', '.join(_registry)}") from None
+
+
+register(Source(DEFAULT_SOURCE, 'https://dragonslair.se/lanebiblioteket/', title='Lånebiblioteket',
+                params={'restore_auto_pagination': 'true'},
+                name_removals=('-Lånebiblioteket- ', '-Lånebiblioteket -')))
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from output_files import OUTPUT_DIR, write_atomic, state_version
+
+logger = logging.getLogger(__name__)
+
+# Summary of the saved state, written after every full update. Like the rest of
+# the command line path it only uses the standard library, so an update can tell
+# that nothing changed without importing pandas or reading the state.
+DIGEST_PATH = os.path.join(OUTPUT_DIR, 'state_digest.json')
+
+
+def availability_hash(games):
+    '''
+    Hash the sources, names and states of the cleaned games, in any order. The
+    state is keyed by source and name, so a game moving between sources or two
+    sources swapping states changes the hash.
+    '''
+    lines = sorted(f"{game['source']}\t{game['name']}\t{game['state']}" for game in games)
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def load_digest(path=DIGEST_PATH):
+    '''
+    Load the digest, or return None if there is none or it can't be read.
+    '''
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable state digest: {e}")
+        return None
+
+
+def write_digest(availability, settled, next_lookup_at, next_refresh_at=None, path=DIGEST_PATH):
+    '''
+    Write the digest of the state that was just saved (or found unchanged).
+
+    availability is the availability_hash of the games of the run, settled is
+    True if every game has the status 'No Change', and next_lookup_at is when
+    the first pending BGG lookup is due (0 for now, None if nothing is pending).
+    next_refresh_at is when the statistics of the first game are due for a
+    refresh, kept apart as updates can turn the refresh off.
+    '''
+    digest = {
+        'state_version': state_version(),
+        'availability': availability,
+        'settled': settled,
+        'next_lookup_at': next_lookup_at,
+        'next_refresh_at': next_refresh_at
+    }
+
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(digest, file)
+
+    write_atomic(path, write)
+
+
+def state_unchanged(availability, now=None, refresh=True, path=DIGEST_PATH):
+    '''
+    Return True if an update with these games would leave the state as it is:
+    the state file wasn't written since the digest, the availability is the same,
+    the statuses are settled and no BGG lookup (or refresh, if refresh is True)
+    is due.
+    '''
+    digest = load_digest(path)
+    if digest is None:
+        return False
+    version = state_version()
+    now = now or time.time()
+    due = [digest.get('next_lookup_at')] + ([digest.get('next_refresh_at')] if refresh else [])
+    return (digest.get('state_version') == (list(version) if version else None)
+            and digest.get('availability') == availability
+            and digest.get('settled') is True
+            and all(at is None or at > now for at in due))
@@ -0,0 +1,201 @@
+import logging
+import os
+
+import pandas as pd
+
+from output_files import (OUTPUT_DIR, STATE_PATH, CSV_PATH, DELTA_PATH, PARQUET_AVAILABLE,  # noqa: F401
+                          write_atomic, file_version, state_version)
+from sources import DEFAULT_SOURCE
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ['No Change', 'State Change', 'New Game', 'Removed']
+COLUMNS = ['source', 'name', 'state_previous', 'state_current', 'state_since', 'status', 'id', 'match_confidence', 'title', 'year',
+           'best_with', 'recommended_with', 'avg_rating', 'no_ratings', 'bgg_rank', 'bgg_fetched_at']
+DTYPES = {
+    'source': 'category',
+    'name': 'string',
+    'state_previous': 'category',
+    'state_current': 'category',
+    'state_since': 'datetime64[ns]',
+    'status': pd.CategoricalDtype(STATUSES),
+    'id': 'Int64',
+    'match_confidence': 'float64',
+    'title': 'string',
+    'year': 'Int64',
+    'best_with': 'string',
+    'recommended_with': 'string',
+    'avg_rating': 'float64',
+    'no_ratings': 'Int64',
+    'bgg_rank': 'Int64',
+    'bgg_fetched_at': 'datetime64[ns]'
+}
+# Values of the columns added to a state written by an older version
+COLUMN_DEFAULTS = {
+    'source': DEFAULT_SOURCE
+}
+# A game is identified by its source and name
+KEY_COLUMNS = ['source', 'name']
+# The state file is written in full again once the delta holds this share of the games
+DELTA_SHARE = 0.2
+
+def coerce_types(df):
+    '''
+    Convert the columns of a DataFrame to the types of the store. Values that
+    don't fit the type, such as the ID 'Unknown' or the rank 'Not Ranked',
+    become missing values.
+    '''
+    df = df.copy()
+    for column, dtype in DTYPES.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        values = df[column]
+        if dtype in ('Int64', 'float64'):
+            numbers = pd.to_numeric(values, errors='coerce')
+            df[column] = numbers.round().astype(dtype) if dtype == 'Int64' else numbers.astype(dtype)
+        elif dtype == 'datetime64[ns]':
+            df[column] = pd.to_datetime(values, errors='coerce').astype(dtype)
+        elif dtype == 'string':
+            df[column] = values.astype(object).where(values.notna(), None).astype(dtype)
+        else:
+            df[column] = values.astype(dtype)
+    return df
+
+
+def empty_state(columns=None):
+    '''
+    Return an empty DataFrame with the columns and types of the store.
+    '''
+    return coerce_types(pd.DataFrame(columns=columns or COLUMNS))
+
+
+def state_exists():
+    return os.path.exists(STATE_PATH) or os.path.exists(CSV_PATH)
+
+
+def states_equal(df, other):
+    '''
+    Return True if two states have the same games with the same values.
+    '''
+    df, other = (coerce_types(state)[COLUMNS].reset_index(drop=True).astype(object) for state in (df, other))
+    return df.equals(other)
+
+
+def add_missing_columns(df, columns):
+    '''
+    Add the columns a state written by an older version doesn't have yet, with
+    their default value or as missing values.
+    '''
+    missing = [column for column in columns if column not in df.columns]
+    for column in missing:
+        df[column] = COLUMN_DEFAULTS.get(column)
+    return coerce_types(df) if missing else df
+
+
+def read_parquet_columns(path, columns):
+    import pyarrow.parquet as pq
+    stored = set(pq.read_schema(path).names)
+    return add_missing_columns(pd.read_parquet(path, columns=[column for column in columns if column in stored]), columns)
+
+
+def apply_delta(df, delta):
+    '''
+    Return the state with the rows of the delta replacing the rows of the same
+    games, and the games that are only in the delta added at the end.
+    '''
+    keys = pd.MultiIndex.from_frame(df[KEY_COLUMNS].astype(object))
+    replaced = keys.isin(pd.MultiIndex.from_frame(delta[KEY_COLUMNS].astype(object)))
+    return coerce_types(pd.concat([df.loc[~replaced], delta], ignore_index=True))
+
+
+def load_state(columns=None):
+    '''
+    Load the typed state, reading only the given columns. The rows of the delta,
+    if there is one, replace the rows of the state file. Falls back to the CSV
+    export if there is no Parquet file yet (or pyarrow is not installed), and
+    returns an empty state if neither exists.
+    '''
+    if PARQUET_AVAILABLE and os.path.exists(STATE_PATH):
+        read_columns = COLUMNS if columns is None else list(dict.fromkeys(KEY_COLUMNS + columns))
+        df = read_parquet_columns(STATE_PATH, read_columns)
+        if os.path.exists(DELTA_PATH):
+            df = apply_delta(df, read_parquet_columns(DELTA_PATH, read_columns))
+        return df if columns is None else df[columns]
+    if os.path.exists(CSV_PATH):
+        logger.info(f"Loading state from {CSV_PATH}")
+        if columns is None:
+            return add_missing_columns(coerce_types(pd.read_csv(CSV_PATH)), COLUMNS)
+        stored = set(pd.read_csv(CSV_PATH, nrows=0).columns)
+        df = coerce_types(pd.read_csv(CSV_PATH, usecols=[column for column in columns if column in stored]))
+        return add_missing_columns(df, columns)[columns]
+    return empty_state(columns)
+
+
+def export_csv(df, path=CSV_PATH):
+    '''
+    Export the state as CSV.
+    '''
+    write_atomic(path, lambda tmp_path: df.to_csv(tmp_path, index=False))
+
+
+def changed_rows(df, previous):
+    '''
+    Return the rows of df that are new or differ from the row of the same game
+    in previous, or None if a game of previous is gone or a game is in a state
+    twice, as a delta can't express that.
+    '''
+    new = df.set_index(KEY_COLUMNS).astype(object)
+    old = coerce_types(previous)[df.columns].set_index(KEY_COLUMNS).astype(object)
+    if not (new.index.is_unique and old.index.is_unique) or not old.index.isin(new.index).all():
+        return None
+    old = old.reindex(new.index)
+    same = (new == old).fillna(False) | (new.isna() & old.isna())
+    return df.loc[~same.all(axis=1).to_numpy()]
+
+
+def save_delta(df, previous):
+    '''
+    Write the rows of df that changed since previous, the state as it was last
+    saved or loaded, to the delta. Returns False if the state file has to be
+    written in full instead: there is none yet, a game is gone or the delta has
+    grown to DELTA_SHARE of the games.
+    '''
+    if not os.path.exists(STATE_PATH):
+        return False
+    changed = changed_rows(df, previous)
+    if changed is None:
+        return False
+    if changed.empty:
+        return True
+    if os.path.exists(DELTA_PATH):
+        delta = read_parquet_columns(DELTA_PATH, list(df.columns))
+        changed = coerce_types(pd.concat([delta, changed], ignore_index=True)).drop_duplicates(subset=KEY_COLUMNS, keep='last')
+    if len(changed) > DELTA_SHARE * len(df):
+        return False
+    write_atomic(DELTA_PATH, lambda tmp_path: changed.to_parquet(tmp_path, index=False))
+    logger.info(f"Saved {len(changed)} changed games to the state delta")
+    return True
+
+
+def save_state(df, csv_export=True, previous=None):
+    '''
+    Save the state with the types of the store, and export it as CSV unless
+    csv_export is False. Returns the state as it was saved.
+
+    With the previous state and without the CSV export, only the changed games
+    are written, to the delta next to the state file. The state file is written
+    in full, and the delta removed, once the delta has grown too large.
+    '''
+    df = coerce_types(df)[[column for column in COLUMNS if column in df.columns]]
+    if PARQUET_AVAILABLE:
+        if csv_export or previous is None or not save_delta(df, previous):
+            write_atomic(STATE_PATH, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+            # The state file has every change now, a crash before the delta is removed is harmless
+            if os.path.exists(DELTA_PATH):
+                os.remove(DELTA_PATH)
+    else:
+        logger.warning("pyarrow is not installed, saving the state as CSV only")
+        csv_export = True
+    if csv_export:
+        export_csv(df)
+    return df
@@ -1,29 +1,65 @@
 import streamlit as st
-import pandas as pd
-import subprocess
-import sys
+from datetime import datetime
+from data_loader import load_data, load_recently_updated, load_filter_index, load_recommendation_index, clear_cache, RECENT_DAYS
+from update_job import start_update, cancel_update, job_status, job_log, JOB_LOG_PATH
 
 
 # Make streamlit layout wide
 st.set_page_config(layout="wide")
 st.logo('../assets/dragons-lair-logo.webp')
 
-# Function to run the main.py script
-def run_main_script():
-
-    try:
-        st.write('Running the update script...')
-        subprocess.run([f"{sys.executable}", "../main.py"])
-        st.success('Update script completed successfully.')
-    except Exception as e:
-        st.write('Error running the update script.')
-        st.error(f"Error: {e}")
+STAGES = {'starting': 'Starting', 'scrape': 'Fetching pages', 'ids': 'Resolving BGG IDs',
+          'details': 'Fetching game details', 'save': 'Saving'}
+FILTERS = {'source': 'Source', 'state_current': 'State', 'status': 'Status', 'played': 'Played',
+           'wishlist': 'Wishlist', 'year': 'Year', 'players': 'Number of players'}
+
+# Show the progress of the background update, refreshed every 2 seconds
+@st.fragment(run_every=2)
+def update_progress():
+    status = job_status()
+    counts = status['counts']
+
+    process = st.session_state.get('update_process')
+    if (st.session_state.get('update_started') and process is not None and process.poll() is not None
+            and (status.get('started_at') or '') < st.session_state['update_started']):
+        # The update process exited before it took the lock, e.g. it crashed or
+        # found another update running
+        st.session_state['update_started'] = None
+        st.session_state['update_error'] = (process.returncode, job_log())
+
+    if st.session_state.get('update_error'):
+        returncode, log = st.session_state['update_error']
+        st.error(f'The update exited before it started (exit code {returncode}). Its output is in {JOB_LOG_PATH}:')
+        st.code(log or '(no output)')
+
+    if status['running']:
+        st.write(f"Running: {STAGES.get(status['stage'], status['stage'])}...")
+        col1, col2, col3 = st.columns(3)
+        col1.metric('Pages fetched', counts.get('pages_fetched', 0))
+        col2.metric('IDs resolved', f"{counts.get('ids_resolved', 0)} / {counts.get('ids_total', 0)}")
+        col3.metric('Details fetched', f"{counts.get('details_fetched', 0)} / {counts.get('details_total', 0)}")
+        if st.button('Cancel Update'):
+            cancel_update()
+            st.warning('Cancelling the update...')
+
+    elif st.session_state.get('update_started'):
+        if (status.get('started_at') or '') < st.session_state['update_started']:
+            # The update process hasn't taken the lock yet
+            st.write('Starting the update...')
+            return
+
+        # The update started from this session has ended
+        st.session_state['update_started'] = None
+        if status['status'] == 'finished':
+            clear_cache()
+            st.rerun()
+        elif status['status'] == 'cancelled':
+            st.warning('Update cancelled. Fetched results are kept for the next update.')
+        else:
+            st.error(f"Update failed: {status.get('error')}")
 
 # Load the data
-data_path = '../output/final_data.csv'
-df = pd.read_csv(data_path, parse_dates=['state_since']
-                 ,dtype={'id': str, 'bgg_rank': str, 'year': str,
-                        'avg_rating': float, 'played': bool, 'wishlist': bool})
+df = load_data()
 
 # Display the data
 st.image('../assets/dragons-lair-logo.webp', width=500)
@@ -33,37 +69,34 @@ st.title('Lånebiblioteket')
 with st.container(border=True):
     st.write('### Update Portfolio')
     if st.button('Run Update Script'):
-        st.write('#### Log')
-        run_main_script()
+        started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        process = start_update()
+        if process is not None:
+            st.session_state['update_started'] = started_at
+            st.session_state['update_process'] = process
+            st.session_state['update_error'] = None
+        else:
+            st.warning('An update is already running.')
+    update_progress()
     st.write(f'***Last updated: {df["state_since"].max().strftime("%Y-%m-%d")}***')
 
 
-# 
-today = pd.to_datetime('today')
-df['state_since'] = pd.to_datetime(df['state_since'], errors='coerce')
-
-days_since_change = 7 # Number of days to consider a game as recently updated
-state_change_games = df.loc[(df['status'] == 'State Change') 
-                            | ((today - df['state_since']).dt.days < days_since_change)].sort_values(
-                                ['state_since', 'avg_rating'], ascending=False)
+state_change_games = load_recently_updated()
 
 st.write('## Recently Updated Games')
-st.info('Games updated within last week or changed state in last run')
-st.write(state_change_games.reset_index(drop=True))
+st.info(f'Games updated within last {RECENT_DAYS} days or changed state in last run')
+st.write(state_change_games)
 
-# Filter options
+# Filter options, every column can select several values. The filters are
+# served from the masks of the filter index instead of scanning the games
 st.sidebar.header('Filter Options')
-columns = df.columns.tolist()
-
-# Select column to filter
-selected_column = st.sidebar.selectbox('Select column to filter', columns)
-
-# Select filter value
-unique_values = df[selected_column].unique()
-selected_value = st.sidebar.selectbox('Select value to filter', unique_values)
+filter_index = load_filter_index()
+selections = {column: st.sidebar.multiselect(label, filter_index.values[column])
+              for column, label in FILTERS.items()}
 
 # Apply filter
-filtered_df = df[df[selected_column] == selected_value]
+mask = filter_index.mask(selections)
+filtered_df = df[mask]
 
 # Display filtered data
 with st.container(border=True):
@@ -74,3 +107,15 @@ with st.container(border=True):
     col3.metric('Number of played games', filtered_df.loc[filtered_df['played'] == True].shape[0])
     st.write(filtered_df)
 
+# Recommendations for the profile of the played and wishlisted games, among the filtered games
+with st.container(border=True):
+    st.write('## Find Your Next Game')
+    st.info('Games like the ones you played and wishlisted, ranked by rating, popularity, '
+            'fit for the selected number of players and availability.')
+    prefer_available = st.checkbox('Prefer available games', value=True)
+    positions, scores = load_recommendation_index().rank(
+        df['played'].to_numpy(dtype=bool), df['wishlist'].to_numpy(dtype=bool),
+        players=selections['players'], prefer_available=prefer_available, mask=mask)
+    recommendations = df.iloc[positions][['source', 'name', 'state_current', 'title', 'year', 'best_with',
+                                          'recommended_with', 'avg_rating', 'no_ratings', 'bgg_rank']]
+    st.dataframe(recommendations.assign(score=scores.round(2)), hide_index=True)
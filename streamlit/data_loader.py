@@ -0,0 +1,173 @@
+import os
+import sys
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# Make the project modules importable
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from state_store import file_version, state_version, load_state
+from event_log import EVENT_LOG_PATH, availability_fraction
+from annotations import ANNOTATIONS_PATH, join_annotations
+from recommend import FilterIndex, RecommendationIndex
+
+# Number of days to consider a game as recently updated
+RECENT_DAYS = 7
+# Above this many games the charts show binned aggregates instead of every game
+SCATTER_POINT_LIMIT = 5000
+# Number of bins per axis of the binned charts
+CHART_BINS = 40
+
+
+def data_version():
+    return state_version(), file_version(ANNOTATIONS_PATH)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_cached_data(version, day):
+    '''
+    Load the typed state, join the user annotations and add the derived columns.
+    Cached per data version and day, as the derived columns depend on today's date.
+    '''
+    df = join_annotations(load_state())
+
+    # Derived columns used by the pages
+    today = pd.Timestamp('today')
+    df['days_since_change'] = (today - df['state_since']).dt.days
+    df['recently_updated'] = (df['status'] == 'State Change') | (df['days_since_change'] < RECENT_DAYS)
+    return df
+
+
+def load_data():
+    '''
+    Return the game data, typed and with derived columns. The DataFrame is shared
+    between reruns and sessions, so pages must copy it before changing it.
+    '''
+    return load_cached_data(data_version(), date.today())
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_cached_recently_updated(version, day):
+    df = load_cached_data(version, day)
+    return df.loc[df['recently_updated']].sort_values(['state_since', 'avg_rating'], ascending=False).reset_index(drop=True)
+
+
+def load_recently_updated():
+    '''
+    Return the games updated within RECENT_DAYS or that changed state in the last run.
+    '''
+    return load_cached_recently_updated(data_version(), date.today())
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_cached_chart_data(version, day):
+    df = load_cached_data(version, day)
+    chart_data = df.loc[df['avg_rating'].notna() & df['no_ratings'].notna(),
+                        ['name', 'source', 'avg_rating', 'no_ratings', 'state_current', 'played']]
+    return chart_data.astype({'no_ratings': 'float64'}).reset_index(drop=True)
+
+
+def load_chart_data():
+    '''
+    Return the columns of the Main Page charts for the games with BGG ratings,
+    prepared once per data version.
+    '''
+    return load_cached_chart_data(data_version(), date.today())
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def load_cached_binned_chart_data(version, day, column, value, bins):
+    chart_data = load_cached_chart_data(version, day)
+    x, y = chart_data['avg_rating'].to_numpy(), chart_data['no_ratings'].to_numpy()
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+    matches = (chart_data[column] == value).fillna(False).to_numpy(dtype=bool)
+    hits, _, _ = np.histogram2d(x[matches], y[matches], bins=[x_edges, y_edges])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(counts > 0, hits / counts, np.nan)
+    # Rows of the arrays are the y bins, as plotly heatmaps expect
+    return {
+        'x': (x_edges[:-1] + x_edges[1:]) / 2,
+        'y': (y_edges[:-1] + y_edges[1:]) / 2,
+        'count': counts.T,
+        'share': share.T
+    }
+
+
+def load_binned_chart_data(column, value, bins=CHART_BINS):
+    '''
+    Return the chart data binned on a bins x bins grid of average rating and
+    number of ratings: the bin centers, the number of games in every bin and the
+    share of them where column equals value (NaN for empty bins).
+    '''
+    return load_cached_binned_chart_data(data_version(), date.today(), column, value, bins)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_cached_filter_index(version, day):
+    return FilterIndex.from_games(load_cached_data(version, day))
+
+
+def load_filter_index():
+    '''
+    Return the filter index of the game data, built once per data version. Its
+    masks are aligned with the rows of load_data.
+    '''
+    return load_cached_filter_index(data_version(), date.today())
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_cached_recommendation_index(version, day):
+    return RecommendationIndex.from_games(load_cached_data(version, day))
+
+
+def load_recommendation_index():
+    '''
+    Return the feature matrix of the game data for recommendations, built once
+    per data version. Its rows are aligned with the rows of load_data.
+    '''
+    return load_cached_recommendation_index(data_version(), date.today())
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_cached_availability(days, version):
+    return availability_fraction(days)
+
+
+def load_availability(days):
+    '''
+    Return the share of the last days that each game was available, cached until
+    the event log changes.
+    '''
+    return load_cached_availability(days, file_version(EVENT_LOG_PATH))
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def load_cached_demand(days, events_version, version, day):
+    df = load_cached_data(version, day)
+    demand = load_cached_availability(days, events_version).merge(
+        df[['source', 'name', 'avg_rating', 'state_current']], how='left', on=['source', 'name'])
+    return demand.sort_values('available_fraction').reset_index(drop=True)
+
+
+def load_demand(days):
+    '''
+    Return the availability of the last days with the rating and current state
+    of every game, least available first.
+    '''
+    return load_cached_demand(days, file_version(EVENT_LOG_PATH), data_version(), date.today())
+
+
+def clear_cache():
+    '''
+    Drop the cached data, for example after an update has written new output.
+    '''
+    load_cached_data.clear()
+    load_cached_recently_updated.clear()
+    load_cached_chart_data.clear()
+    load_cached_binned_chart_data.clear()
+    load_cached_filter_index.clear()
+    load_cached_recommendation_index.clear()
+    load_cached_demand.clear()
+    load_cached_availability.clear()
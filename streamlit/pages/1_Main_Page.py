@@ -1,21 +1,60 @@
+import math
+
 import streamlit as st
-import pandas as pd
 import plotly.express as px
-import numpy as np
+import plotly.graph_objects as go
+from data_loader import load_data, load_chart_data, load_binned_chart_data, load_demand, SCATTER_POINT_LIMIT
+from event_log import game_timeline
+from sources import DEFAULT_SOURCE
 
 
 # Make streamlit layout wide
 st.set_page_config(layout="wide")
 st.logo('../assets/dragons-lair-logo.webp')
 
+# Rows per page of the tables
+PAGE_SIZE = 100
+
 # Function to run the main.py script
 def run_main_script():
     # Ensure required modules are installed
     st.error('Function not implemented.')
 
+
+def paginated_dataframe(container, df, key, **kwargs):
+    '''
+    Show a table one page at a time, so only PAGE_SIZE rows are sent to the browser.
+    '''
+    pages = max(math.ceil(len(df) / PAGE_SIZE), 1)
+    page = container.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1, key=key) if pages > 1 else 1
+    start = (page - 1) * PAGE_SIZE
+    container.dataframe(df.iloc[start:start + PAGE_SIZE], **kwargs)
+    container.caption(f'Rows {min(start + 1, len(df))}-{min(start + PAGE_SIZE, len(df))} of {len(df)}')
+
+
+def scatter_chart(chart_data, color, color_map):
+    # WebGL traces keep the browser responsive with thousands of points
+    fig = px.scatter(chart_data, x='avg_rating', y='no_ratings', color=color, hover_name='name', render_mode='webgl',
+                     title='Scatter plot of Average Rating vs Number of Ratings', color_discrete_map=color_map)
+    fig.update_layout(legend=dict(orientation="h", yanchor="top", y=-0.2, xanchor="center", x=0.5))
+    return fig
+
+
+def binned_chart(column, value, label):
+    # The bins are computed once per data version, only the grid is sent to the browser
+    binned = load_binned_chart_data(column, value)
+    fig = go.Figure(go.Heatmap(x=binned['x'], y=binned['y'], z=binned['share'], customdata=binned['count'],
+                               zmin=0, zmax=1, colorscale=[[0, 'indianred'], [1, 'mediumspringgreen']],
+                               colorbar=dict(title=label),
+                               hovertemplate='Average rating %{x:.2f}<br>Number of ratings %{y:.0f}<br>'
+                                             'Games %{customdata:.0f}<br>' + label + ' %{z:.0%}<extra></extra>'))
+    fig.update_layout(title=f'Share {label.lower()} by Average Rating and Number of Ratings',
+                      xaxis_title='avg_rating', yaxis_title='no_ratings')
+    return fig
+
+
 # Load the data
-data_path = '../output/final_data.csv'
-df = pd.read_csv(data_path)
+df = load_data()
 
 st.image('../assets/dragons-lair-logo.webp', width=500)
 
@@ -23,24 +62,40 @@ st.title('Lånebiblioteket')
 
 
 st.write('### All Games')
-st.write(df)
+paginated_dataframe(st, df, 'all_games_page')
 
-# Select data for scatter plot
-scatter_data = df[['name', 'avg_rating', 'no_ratings', 'state_current', 'bgg_rank', 'played']]
-scatter_data['bgg_rank'] = scatter_data['bgg_rank'].replace('Not Ranked', np.nan).dropna().astype(int)
+# Data for the scatter plots, prepared once per data version
+chart_data = load_chart_data()
 
 # Filter options
 st.sidebar.header('Sidebar')
 columns = df.columns.tolist()
+chart_mode = st.sidebar.radio('Chart mode', ['Auto', 'Points', 'Binned'],
+                              help=f'Auto shows every game up to {SCATTER_POINT_LIMIT} games and binned aggregates above that.')
+binned = chart_mode == 'Binned' or (chart_mode == 'Auto' and len(chart_data) > SCATTER_POINT_LIMIT)
 
 col1, col2 = st.columns(2)
 
-fig1 = px.scatter(scatter_data, x='avg_rating', y='no_ratings', color='state_current', hover_name='name', title='Scatter plot of Average Rating vs Number of Ratings',
-                 color_discrete_map={'Available': 'mediumspringgreen', 'Unavailable': 'indianred'})
-fig1.update_layout(legend=dict(orientation="h", yanchor="top", y=-0.2, xanchor="center", x=0.5))
+if binned:
+    fig1 = binned_chart('state_current', 'Available', 'Available')
+    fig2 = binned_chart('played', True, 'Played')
+else:
+    fig1 = scatter_chart(chart_data, 'state_current', {'Available': 'mediumspringgreen', 'Unavailable': 'indianred'})
+    fig2 = scatter_chart(chart_data, 'played', {True: 'mediumspringgreen', False: 'indianred'})
 col1.plotly_chart(fig1)
-
-fig2 = px.scatter(df, x='avg_rating', y='no_ratings', color='played', hover_name='name', title='Scatter plot of Average Rating vs Number of Ratings',
-                 color_discrete_map={True: 'mediumspringgreen', False: 'indianred'})
-fig2.update_layout(legend=dict(orientation="h", yanchor="top", y=-0.2, xanchor="center", x=0.5))
 col2.plotly_chart(fig2)
+
+# Lending demand from the availability history
+st.write('### Lending Demand')
+days = st.sidebar.slider('Days of availability history', min_value=7, max_value=365, value=30)
+st.info(f'Share of the last {days} days that each game was available to borrow. Games that are rarely available are in high demand.')
+
+col1, col2 = st.columns(2)
+paginated_dataframe(col1, load_demand(days), 'demand_page',
+                    column_config={'available_fraction': st.column_config.ProgressColumn('Available', min_value=0, max_value=1)})
+
+# A game has a history per source, the source is only asked for if there are several
+sources = sorted(df['source'].dropna().unique())
+selected_source = col2.selectbox('Source', sources) if len(sources) > 1 else (sources[0] if sources else DEFAULT_SOURCE)
+selected_game = col2.selectbox('Availability history of game', df.loc[df['source'] == selected_source, 'name'].sort_values())
+col2.dataframe(game_timeline(selected_game, selected_source))
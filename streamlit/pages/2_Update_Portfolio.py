@@ -1,14 +1,14 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
+from data_loader import load_data
+from annotations import FIELDS, upsert
+from name_index import REVIEW_THRESHOLD
 
 # Make Streamlit layout wide
 st.set_page_config(layout="wide", page_title="Update Portfolio")
 st.logo('../assets/dragons-lair-logo.webp')
 
-# Load the data
-data_path = '../output/final_data.csv'
-df = pd.read_csv(data_path)
+# Load the data, copied because it is edited below
+df = load_data().copy()
  
 st.image('../assets/dragons-lair-logo.webp', width=500)
 st.title('Lånebiblioteket')
@@ -31,25 +31,31 @@ filtered_df = df[df[selected_column] == selected_value]
 st.write('## Filtered Data')
 st.write(filtered_df)
 
+# Games matched to a BGG title with low confidence
+to_review = df.loc[df['match_confidence'] < REVIEW_THRESHOLD, ['name', 'title', 'id', 'match_confidence']]
+if not to_review.empty:
+    st.write('## Matches to Review')
+    st.write(f'These games were matched to a BoardGameGeek title with a confidence below {REVIEW_THRESHOLD}.')
+    st.dataframe(to_review.sort_values('match_confidence'), hide_index=True)
+
 # Open data in data editor
 st.write('## Data Editor')
 #st.write('You can edit the played and wishlist fields below. Click "Save Data" to save the changes.')
-df_editor = df[[ 'name', 'played', 'wishlist', 'status', 'state_current', 'best_with', 'recommended_with', 'bgg_rank']].copy()
+df_editor = df[[ 'source', 'name', 'played', 'wishlist', 'status', 'state_current', 'best_with', 'recommended_with', 'bgg_rank']].copy()
 
 df_editor = st.data_editor(df_editor,
-                           disabled=('name', 'status', 'state_current', 'best_with', 'recommended_with', 'bgg_rank'))
+                           disabled=('source', 'name', 'status', 'state_current', 'best_with', 'recommended_with', 'bgg_rank'))
+
+# Save the edited `played` and `wishlist` values to the annotation store
+# The editor keeps the index of df, so the rows are compared by label
+fields = list(FIELDS)
+edited = (df_editor[fields] != df.loc[df_editor.index, fields]).any(axis=1)
 
-# Save updated `played` and `wishlist` columns back to the full data and CSV file
 # Display warning if user tries to leave the page without saving
-if df[['played', 'wishlist']].equals(df_editor[['played', 'wishlist']]):
-    pass
-else:
+if edited.any():
     st.warning('Values updated. Please save before leaving the page.')
 
 if st.button('Save Data'):
-    # Update the original DataFrame with the edited columns
-    df.update(df_editor[['name', 'played', 'wishlist']])
-    
-    # Save the full DataFrame to the CSV file
-    df.to_csv(data_path, index=False)
-    st.success('Data saved successfully.')
+    # Write only the edited games, keyed by name, so the flags apply to the game in every source
+    count = upsert(df_editor.loc[edited, ['name', *fields]])
+    st.success(f'Saved {count} games.')
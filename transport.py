@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a connection and for the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Retries of connection errors, timeouts and these status codes
+MAX_RETRIES = 3
+RETRY_STATUSES = (500, 502, 503, 504)
+BACKOFF = 1.0
+# Connections kept alive per host, callers running more requests to a host at
+# the same time grow the pool with ensure_pool_size
+POOL_SIZE = 10
+
+
+class Transport:
+    '''
+    Shared HTTP transport for the scraper and the BGG client.
+
+    Every host gets its own requests.Session with a pool of keep-alive
+    connections, and all requests use the same timeouts and retry policy.
+    Requests, bytes received and retries are counted per host.
+
+    host_overrides maps a host name to a base URL that is used instead, so the
+    requests can be pointed at a local stand-in server, for example
+    {'boardgamegeek.com': 'http://127.0.0.1:8000'}.
+    '''
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_retries=MAX_RETRIES,
+                 backoff=BACKOFF, pool_size=POOL_SIZE, host_overrides=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.host_overrides = host_overrides or {}
+        self.sessions = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def session(self, host):
+        '''
+        Return the session of a host, creating it on first use.
+        '''
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                self.mount(session)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def mount(self, session):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def ensure_pool_size(self, size):
+        '''
+        Grow the connection pool of every host to at least size connections, so
+        that many requests to one host at the same time all keep their
+        connection alive instead of urllib3 discarding the extra ones. Existing
+        sessions get a new pool, so call this before the requests start.
+        '''
+        with self.lock:
+            if size <= self.pool_size:
+                return
+            self.pool_size = size
+            for session in self.sessions.values():
+                self.mount(session)
+
+    def resolve(self, url):
+        '''
+        Apply the host overrides to a URL.
+        '''
+        parts = urlsplit(url)
+        override = self.host_overrides.get(parts.hostname)
+        if override is None:
+            return url
+        base = urlsplit(override)
+        return urlunsplit((base.scheme, base.netloc, base.path.rstrip('/') + parts.path, parts.query, parts.fragment))
+
+    def count(self, host, **increments):
+        with self.lock:
+            counters = self.counters.setdefault(host, {'requests': 0, 'bytes': 0, 'retries': 0, 'errors': 0})
+            for name, value in increments.items():
+                counters[name] += value
+
+    def get(self, url, params=None, headers=None):
+        '''
+        Send a GET request. Connection errors, timeouts and RETRY_STATUSES are
+        retried with exponential backoff. Returns the response, or raises the
+        last requests exception if every attempt failed without a response.
+        '''
+        host = urlsplit(url).hostname
+        endpoint = url_endpoint(url)
+        url = self.resolve(url)
+        session = self.session(host)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = time.perf_counter()
+            try:
+                response = session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.count(host, requests=1, errors=1)
+                metrics.observe_request(endpoint, 'error', time.perf_counter() - started, 0)
+                if last_attempt:
+                    raise
+                logger.warning(f"Request to {host} failed: {e}. Retrying...")
+            else:
+                size = received_bytes(response)
+                self.count(host, requests=1, bytes=size)
+                metrics.observe_request(endpoint, response.status_code, time.perf_counter() - started, size)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+                logger.warning(f"Request to {host} failed with status {response.status_code}. Retrying...")
+
+            self.count(host, retries=1)
+            delay = self.backoff * 2 ** attempt
+            metrics.observe_sleep(endpoint, 'retry_backoff', delay)
+            time.sleep(delay)
+
+    def stats(self):
+        '''
+        Return the counters summed over all hosts and per host.
+        '''
+        with self.lock:
+            per_host = {host: dict(counters) for host, counters in self.counters.items()}
+        totals = {'requests': 0, 'bytes': 0, 'retries': 0, 'errors': 0}
+        for counters in per_host.values():
+            for name, value in counters.items():
+                totals[name] += value
+        return {**totals, 'hosts': per_host}
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+def url_endpoint(url):
+    '''
+    Return the endpoint of a URL, its host and path, as used in the metrics.
+    '''
+    parts = urlsplit(url)
+    return parts.hostname + parts.path
+
+
+def received_bytes(response):
+    '''
+    Return the number of bytes received over the wire, before decompression.
+    '''
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return len(response.content)
+
+
+_transport = None
+
+
+def get_transport():
+    '''
+    Return the shared transport, creating it on first use.
+    '''
+    global _transport
+    if _transport is None:
+        _transport = Transport()
+    return _transport
+
+
+def set_transport(transport):
+    '''
+    Replace the shared transport, for example with one pointing at a local server.
+    '''
+    global _transport
+    _transport = transport
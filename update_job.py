@@ -0,0 +1,223 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+import progress
+from output_files import OUTPUT_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+LOCK_PATH = os.path.join(OUTPUT_DIR, 'update.lock')
+JOB_LOG_PATH = os.path.join(OUTPUT_DIR, 'update_job.log')
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+# Byte locked on Windows, past the pid written at the start of the lock file
+WINDOWS_LOCK_OFFSET = 64
+# Windows process access right and exit code of a running process
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+
+
+# Signal that cancels the running update of a process. A daemon only cancels its
+# current cycle and keeps running, SIGTERM stops it. Windows has no SIGUSR1
+CANCEL_SIGNAL = getattr(signal, 'SIGUSR1', signal.SIGTERM)
+
+
+class UpdateRunning(Exception):
+    ''' Raised when another process holds the update lock. '''
+
+
+class UpdateCancelled(BaseException):
+    '''
+    Raised in an update cancelled with CANCEL_SIGNAL. Like KeyboardInterrupt it
+    is not an Exception, so the error handling of the update doesn't swallow it.
+    '''
+
+
+class UpdateLock:
+    '''
+    Cross-process lock held by a running update, so only one update writes the
+    output at a time. The lock is released by the operating system if the
+    process dies.
+
+    The holder writes its pid into the lock file, so other processes can tell
+    whether an update is running without taking the lock (see is_running).
+    On Windows a byte past the pid is locked, as a locked byte can't be read.
+    '''
+
+    def __init__(self, path=LOCK_PATH):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.file.seek(WINDOWS_LOCK_OFFSET)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            self.file.close()
+            self.file = None
+            raise UpdateRunning(f"Another update holds {self.path}")
+        self.write_pid(f"{os.getpid()}\n")
+
+    def write_pid(self, content):
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(content)
+        self.file.flush()
+
+    def release(self):
+        if self.file is None:
+            return
+        self.write_pid('')
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        else:
+            self.file.seek(WINDOWS_LOCK_OFFSET)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def pid_alive(pid):
+    '''
+    Return True if a process with the pid exists.
+    '''
+    if fcntl is None:
+        import ctypes
+        # os.kill would terminate the process on Windows
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return exit_code.value == STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def lock_held(path=LOCK_PATH):
+    '''
+    Return True if a process holds the lock, by trying to take it without
+    waiting and releasing it at once. An update starting in that instant fails
+    to take the lock, so this is only a check of last resort (see lock_holder).
+    '''
+    try:
+        file = open(path, 'a+')
+    except OSError:
+        return False
+    with file:
+        try:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                fcntl.flock(file, fcntl.LOCK_UN)
+            else:
+                file.seek(WINDOWS_LOCK_OFFSET)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            return True
+    return False
+
+
+def lock_holder(path=LOCK_PATH):
+    '''
+    Return the pid of the update holding the lock, or None if no update holds it.
+    A pid left by a process that died doesn't count. The pid of a killed update
+    can be reused by another process, so when the pid is alive the lock is
+    probed to confirm it is held. Otherwise the lock isn't touched, so checking
+    doesn't make an update that starts at the same time fail.
+    '''
+    try:
+        with open(path, encoding='utf-8') as file:
+            pid = int(file.read().strip() or 0)
+    except (OSError, ValueError):
+        return None
+    return pid if pid and pid_alive(pid) and lock_held(path) else None
+
+
+def is_running():
+    '''
+    Return True if an update holds the lock.
+    '''
+    return lock_holder() is not None
+
+
+def start_update():
+    '''
+    Start main.py in the background. Returns the process, or None if an update is
+    already running. The update takes the lock itself, so a second update started
+    at the same time exits without doing anything. Its output goes to JOB_LOG_PATH.
+    '''
+    if is_running():
+        return None
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(JOB_LOG_PATH, 'w') as log_file:
+        process = subprocess.Popen([sys.executable, MAIN_SCRIPT], stdout=log_file, stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(MAIN_SCRIPT), start_new_session=True)
+    logger.info(f"Started update {process.pid} in the background")
+    return process
+
+
+def job_log(lines=20):
+    '''
+    Return the last lines of the output of the last update started in the background.
+    '''
+    try:
+        with open(JOB_LOG_PATH, encoding='utf-8', errors='replace') as file:
+            return ''.join(file.readlines()[-lines:])
+    except OSError:
+        return ''
+
+
+def job_status():
+    '''
+    Return the progress of the current or last update, with 'running' telling
+    whether an update holds the lock right now.
+    '''
+    status = progress.read() or {'status': None, 'stage': None, 'counts': {}}
+    status['running'] = is_running()
+    if status['status'] == 'running' and not status['running']:
+        status['status'] = 'failed'  # The process died without reporting
+    return status
+
+
+def cancel_update():
+    '''
+    Ask the running update to stop. Results fetched so far are kept in the
+    checkpoint and reused by the next update. An update of the daemon only ends
+    its cycle, the daemon keeps running. Returns False if nothing is running.
+    '''
+    status = progress.read()
+    if not is_running() or not status or status['status'] != 'running':
+        return False
+    try:
+        os.kill(status['pid'], CANCEL_SIGNAL)
+    except OSError as e:
+        logger.warning(f"Could not cancel update {status['pid']}: {e}")
+        return False
+    return True